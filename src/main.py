@@ -7,18 +7,39 @@ import os
 from fastapi import FastAPI, Body, Path, Request
 from fastapi import Depends, HTTPException, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 import asyncio
 import json
-from urllib.request import Request as URLlibRequest, urlopen as URLlibUrlopen
-from urllib.error import URLError, HTTPError
+from urllib.parse import urlsplit
+import httpx
 import datetime as dt
 import re
-import shutil
 import stat
+import errno
+import glob
+from contextlib import asynccontextmanager, contextmanager
+from collections import deque
+import contextvars
+
+#Application lifespan. Resources shared by the requests (e.g. catalogue connection pools) are released on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  release_worker_claims()
+  requeue_worker_jobs()
+  retire_previous_worker_metrics()
+  metrics_task=asyncio.create_task(save_metrics_loop())
+  reaper_task=asyncio.create_task(trash_reaper_loop())
+  jobs_tasks=[asyncio.create_task(jobs_worker_loop()) for k in range(JOBS_WORKERS)]
+  yield
+  metrics_task.cancel()
+  await stop_jobs_workers(jobs_tasks)
+  await stop_trash_reaper(reaper_task)
+  save_metrics()
+  await close_catalogue_clients()
+  fs_executor.shutdown(wait=True)
 
 #Setup FastAPI
-app = FastAPI(title="Registration Gateway",description="""This API interface allows you to ingest at the same time metadata and related data assets. 
+app = FastAPI(lifespan=lifespan,title="Registration Gateway",description="""This API interface allows you to ingest at the same time metadata and related data assets. 
 
 Auhtorized users can **POST a new STAC Item** into a Collection, linking assets uploaded into S3 stagein bucket associated to the Collection. The assets will be moved to the system long-term storage and the metadata updated and ingested into the sytstem clatalogue for long term data preservation.
 
@@ -46,23 +67,279 @@ The the **STAC Items** posted shall follow the following profile:
 
 #Get current script execution path
 CURPATH = os.path.dirname(os.path.realpath(__file__))
-CFGPATH = os.path.realpath(os.path.join(CURPATH,"../cfg"))
+CFGPATH = os.path.realpath(os.environ.get('REG_API_CFG_PATH',os.path.join(CURPATH,"../cfg")))
+
+#Load configuration
+##As for reg-api-stats, we avoid to use pyyaml here, as we have a very simple YAML file
+##(and the cron syntax in the stats section is not valid for pyyaml)
+def read_simple_yaml(path):
+  data = {}
+  current_group = None
+  with open(path, 'r', encoding='utf-8') as f:
+    for line in f:
+      line = line.strip()
+      #Skip blank lines and comments
+      if not line or line.startswith('#'):
+        continue
+      #Group header
+      if line.endswith(':'):
+        current_group = line[:-1].strip()
+        data[current_group] = {}
+        continue
+      #Key-value line inside a group
+      if current_group and ':' in line:
+        key, value = line.split(':', 1)
+        data[current_group][key.strip()] = value.strip()
+  return data
+
+def load_conf():
+  CFGFILE = os.path.join(CFGPATH,"conf.yaml")
+  cfg=read_simple_yaml(CFGFILE)['config']
+  cfg['config_path']=CFGPATH
+  return cfg
+conf = load_conf()
+
+#Catalogue HTTP client. Requests to the catalogue are asynchronous, so they do not block the other requests.
+#One keep-alive connection pool is kept for each catalogue (scheme and host), and the number of concurrent
+#requests to the catalogue is bounded for each collection (big ItemCollections do not flood the catalogue)
+CATALOGUE_TIMEOUT=httpx.Timeout(float(conf.get('catalogue_timeout',60)),connect=float(conf.get('catalogue_connect_timeout',10)))
+CATALOGUE_LIMITS=httpx.Limits(max_connections=int(conf.get('catalogue_max_connections',20)),max_keepalive_connections=int(conf.get('catalogue_max_keepalive_connections',10)))
+COLLECTION_MAX_CONCURRENCY=int(conf.get('collection_max_concurrency',8))
+#ItemCollections can be posted in batches to the catalogue bulk transaction endpoint (relative to the collection URL)
+CATALOGUE_BULK=conf.get('catalogue_bulk','false').lower()=='true'
+CATALOGUE_BULK_SIZE=int(conf.get('catalogue_bulk_size',100))
+CATALOGUE_BULK_ENDPOINT=conf.get('catalogue_bulk_endpoint','bulk_items')
+catalogue_clients={}
+collection_semaphores={}
+
+def get_catalogue_client(url: str):
+  catalogue=urlsplit(url)[:2]
+  if catalogue not in catalogue_clients:
+    catalogue_clients[catalogue]=httpx.AsyncClient(timeout=CATALOGUE_TIMEOUT,limits=CATALOGUE_LIMITS,follow_redirects=True)
+  return catalogue_clients[catalogue]
+
+async def catalogue_request(method: str, url: str, collectionId: str, content: bytes = None):
+  #Wait for a free slot in the collection before sending the request
+  if collectionId not in collection_semaphores:
+    collection_semaphores[collectionId]=asyncio.Semaphore(COLLECTION_MAX_CONCURRENCY)
+  async with collection_semaphores[collectionId]:
+    try:
+      response=await get_catalogue_client(url).request(method,url,content=content,headers={'Content-Type':'application/geo+json'})
+    except httpx.TransportError:
+      record_catalogue_request(method,'TransportError')
+      raise
+    except Exception:
+      record_catalogue_request(method,'Exception')
+      raise
+  record_catalogue_request(method,str(response.status_code),response.is_error)
+  return response
+
+def catalogue_response_status(response: httpx.Response):
+  return f"HTTP Error {response.status_code}: {response.reason_phrase}"
+
+async def close_catalogue_clients():
+  for client in catalogue_clients.values():
+    await client.aclose()
+  catalogue_clients.clear()
 
 #Use SQLite database to store AAI and other configuration information. Open this in read only mode
+#The service can run with multiple worker processes, so each worker (and each of its threads) opens
+#its own connection on first use, after the worker has been started
 import sqlite3
-con = sqlite3.connect('file:'+os.path.join(CFGPATH,"auth.db")+'?mode=ro',uri=True,check_same_thread=False)
+import threading
+import time
+from collections import OrderedDict
+AUTH_DB_PATH=os.path.join(CFGPATH,"auth.db")
+auth_db=threading.local()
+def get_auth_db():
+  if getattr(auth_db,'pid',None)!=os.getpid():
+    auth_db.con=sqlite3.connect('file:'+AUTH_DB_PATH+'?mode=ro',uri=True)
+    auth_db.pid=os.getpid()
+  return auth_db.con
+
+#The gateway state shared among the workers is stored in a second SQLite database (writable by the service)
+GATEWAY_DB_PATH=os.path.join(CFGPATH,"gateway.db")
+gateway_db=threading.local()
+def get_gateway_db():
+  if getattr(gateway_db,'pid',None)!=os.getpid():
+    gateway_db.con=sqlite3.connect(GATEWAY_DB_PATH,timeout=30,isolation_level=None)
+    gateway_db.con.execute("PRAGMA journal_mode=WAL;")
+    gateway_db.con.execute("CREATE TABLE IF NOT EXISTS claims(claim TEXT PRIMARY KEY, pid INTEGER, created REAL);")
+    gateway_db.con.execute("CREATE TABLE IF NOT EXISTS worker_metrics(pid INTEGER PRIMARY KEY, metrics TEXT, updated REAL);")
+    gateway_db.con.execute("CREATE TABLE IF NOT EXISTS jobs(id TEXT PRIMARY KEY, user_id INTEGER, collection TEXT, type TEXT, status TEXT, items INTEGER, pid INTEGER, created REAL, updated REAL);")
+    gateway_db.con.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status,created);")
+    gateway_db.con.execute("CREATE TABLE IF NOT EXISTS job_items(job TEXT, idx INTEGER, id TEXT, item TEXT, result TEXT, PRIMARY KEY(job,idx));")
+    gateway_db.con.execute("CREATE TABLE IF NOT EXISTS items(collection TEXT, id TEXT, day TEXT, assets TEXT, size INTEGER, PRIMARY KEY(collection,id)) WITHOUT ROWID;")
+    gateway_db.con.execute("CREATE TABLE IF NOT EXISTS items_index(collection TEXT PRIMARY KEY, completed REAL);")
+    gateway_db.pid=os.getpid()
+  return gateway_db.con
+
+#Items and staged assets being ingested are claimed in the gateway DB, so when two requests (also in different
+#workers) try to ingest the same item ID or the same staged asset, only the first one proceeds and the other
+#fails with a conflict. Claims of dead workers, or older than claim_timeout seconds, are considered stale
+CLAIM_TIMEOUT=float(conf.get('claim_timeout',3600))
+def claim_item(collectionId: str, prepared_item: dict):
+  #Returns the list of claims, or None if the item or one of its assets is already claimed
+  return acquire_claims([f"item:{collectionId}/{prepared_item['item']['id']}"]+[f"asset:{asset_src}" for asset_src in prepared_item['assets_to_move_src']])
+
+def claim_items(collectionId: str, prepared_items: list):
+  #Returns the claims of each item, or None for the items already claimed
+  return [claim_item(collectionId,k) for k in prepared_items]
+
+def acquire_claims(claims: list):
+  #Returns the list of claims, or None if one of them is already claimed
+  con=get_gateway_db()
+  for attempt in range(2):
+    con.execute("BEGIN IMMEDIATE;")
+    try:
+      con.executemany("INSERT INTO claims(claim,pid,created) VALUES (?,?,?);",[(c,os.getpid(),time.time()) for c in claims])
+      con.execute("COMMIT;")
+      return claims
+    except sqlite3.IntegrityError:
+      con.execute("ROLLBACK;")
+    except:
+      #Never leave the transaction open on the connection of this thread (e.g. database locked)
+      con.execute("ROLLBACK;")
+      raise
+    if release_stale_claims(claims)==0:
+      break
+  return None
+
+def release_stale_claims(claims: list):
+  #Release the claims held by dead workers (or expired), returns the number of claims released
+  con=get_gateway_db()
+  stale_claims=[]
+  for (claim,pid,created) in con.execute(f"SELECT claim,pid,created FROM claims WHERE claim IN ({','.join('?'*len(claims))});",claims).fetchall():
+    if created<time.time()-CLAIM_TIMEOUT:
+      stale_claims.append((claim,pid))
+      continue
+    try:
+      os.kill(pid,0)
+    except ProcessLookupError:
+      stale_claims.append((claim,pid))
+    except PermissionError:
+      pass
+  con.executemany("DELETE FROM claims WHERE claim=? AND pid=?;",stale_claims)
+  return len(stale_claims)
+
+def release_claims(claims: list):
+  get_gateway_db().executemany("DELETE FROM claims WHERE claim=? AND pid=?;",[(c,os.getpid()) for c in claims])
+
+def release_worker_claims():
+  #Claims with the PID of this worker are leftovers of a previous run (PIDs are reused when the service restarts)
+  get_gateway_db().execute("DELETE FROM claims WHERE pid=?;",(os.getpid(),))
+
+#Failure reasons reported with the 409 Conflict HTTP status
+CONFLICT_FAILURE_REASONS=['Item already exists','Item or its assets are being ingested by another request']
+
+#Cache of the authentication and authorization DB queries, so the requests do not need to query the DB.
+#Entries expire after a given time (TTL), the least recently used are dropped when the cache is full and
+#all the entries are dropped when the DB file changes (e.g. users or authorizations updated via reg-api)
+class AuthCache:
+  def __init__(self, db_path: str, ttl: float, maxsize: int, check_interval: float):
+    self.db_path=db_path
+    self.ttl=ttl
+    self.maxsize=maxsize
+    self.check_interval=check_interval
+    self.entries=OrderedDict()
+    self.lock=threading.Lock()
+    self.db_version=None
+    self.db_last_check=0
+    self.hits=0
+    self.misses=0
+    self.invalidations=0
+
+  def check_db_version(self):
+    #Check the DB file did not change (at most once every check_interval seconds). Call with lock held
+    now=time.monotonic()
+    if now-self.db_last_check < self.check_interval:
+      return
+    self.db_last_check=now
+    try:
+      statinfo=os.stat(self.db_path)
+      db_version=(statinfo.st_ino,statinfo.st_size,statinfo.st_mtime_ns)
+    except OSError:
+      db_version=None
+    if db_version!=self.db_version:
+      if len(self.entries)>0:
+        self.invalidations+=1
+      self.entries.clear()
+      self.db_version=db_version
+
+  def get(self, key):
+    with self.lock:
+      self.check_db_version()
+      entry=self.entries.get(key)
+      if entry is None or entry[0]<time.monotonic():
+        if entry is not None:
+          del self.entries[key]
+        self.misses+=1
+        return None
+      self.entries.move_to_end(key)
+      self.hits+=1
+      return entry[1]
+
+  def put(self, key, value):
+    if self.ttl<=0:
+      return
+    with self.lock:
+      self.entries[key]=(time.monotonic()+self.ttl,value)
+      self.entries.move_to_end(key)
+      while len(self.entries)>self.maxsize:
+        self.entries.popitem(last=False)
+
+  def stats(self):
+    with self.lock:
+      return {"size":len(self.entries),"hits":self.hits,"misses":self.misses,"invalidations":self.invalidations}
+
+AUTH_CACHE_TTL=float(conf.get('auth_cache_ttl',300))
+AUTH_CACHE_SIZE=int(conf.get('auth_cache_size',1000))
+AUTH_CACHE_CHECK_INTERVAL=float(conf.get('auth_cache_check_interval',1))
+credentials_cache=AuthCache(AUTH_DB_PATH,AUTH_CACHE_TTL,AUTH_CACHE_SIZE,AUTH_CACHE_CHECK_INTERVAL)
+authorization_cache=AuthCache(AUTH_DB_PATH,AUTH_CACHE_TTL,AUTH_CACHE_SIZE,AUTH_CACHE_CHECK_INTERVAL)
 
 #Use basic HTTP security for the endpoints (get username/password from the configuration DB)
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import hashlib
 security = HTTPBasic()
-def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
+def get_current_username(request: Request, credentials: HTTPBasicCredentials = Depends(security)):
+  #The authentication time is reported in the request metrics
+  start=time.monotonic()
+  try:
+    return check_credentials(credentials)
+  finally:
+    request.state.auth_seconds=time.monotonic()-start
+
+#The service status endpoints (/status and /metrics) require the users credentials if status_auth is set
+STATUS_AUTH=conf.get('status_auth','false').lower()=='true'
+status_security = HTTPBasic(auto_error=False)
+def check_status_access(credentials: HTTPBasicCredentials = Depends(status_security)):
+  if not STATUS_AUTH:
+    return
+  if credentials is None:
+    raise HTTPException(
+      status_code=status.HTTP_401_UNAUTHORIZED,
+      detail="Not authenticated",
+      headers={"WWW-Authenticate": "Basic"},
+    )
+  check_credentials(credentials)
+
+def check_credentials(credentials: HTTPBasicCredentials):
+  #Check if the credentials have been already verified (only valid credentials are cached, and only in memory,
+  #keyed by the password digest so plaintext passwords are not kept)
+  password_sha256=hashlib.sha256(credentials.password.encode("utf8")).hexdigest()
+  credentials_key=(credentials.username,password_sha256)
+  user_id=credentials_cache.get(credentials_key)
+  if user_id is not None:
+    return user_id
   #Open connection to the db
-  cur = con.cursor()
+  cur = get_auth_db().cursor()
   #Query for the ID. If retreived, the user is logged in
-  cur.execute("SELECT id FROM auth WHERE username = :username AND password_sha256 = :password_sha256;",{"username": credentials.username,"password_sha256": hashlib.sha256(credentials.password.encode("utf8")).hexdigest()})
+  cur.execute("SELECT id FROM auth WHERE username = :username AND password_sha256 = :password_sha256;",{"username": credentials.username,"password_sha256": password_sha256})
   query_result = cur.fetchone()
+  cur.close()
   if query_result and len(query_result) > 0 and query_result[0] is not None:
+    credentials_cache.put(credentials_key,query_result[0])
     return query_result[0]
   else:
     raise HTTPException(
@@ -73,13 +350,19 @@ def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
 
 #Check the authorization using the configuration DB
 def check_user_collection_authorization(user_id: int, collection_name: str):
+  #Check if the authorization is already known
+  authorization_key=(user_id,collection_name)
+  authorization=authorization_cache.get(authorization_key)
+  if authorization is not None:
+    return authorization
   #Open connection to the db
-  cur = con.cursor()
+  cur = get_auth_db().cursor()
   #Query for the collection id map to the user
   cur.execute("SELECT stagein_path, assets_path, stacs_path, datastore_url, cat_post_url, extra_auths FROM user_collection_write_map WHERE collection_name = :collection_name AND user_id= :user_id;",{"user_id": user_id,"collection_name": collection_name})
   query_result = cur.fetchall()
   cur.close()
   if query_result and len(query_result) > 0:
+    authorization_cache.put(authorization_key,query_result[0])
     return query_result[0]
   else:
     raise HTTPException(
@@ -89,6 +372,420 @@ def check_user_collection_authorization(user_id: int, collection_name: str):
     )
 
 
+#Filesystem operations on the staging area and the datastore (assets checks, STAC backup and assets move) can be
+#slow on network filesystems. They run in a dedicated bounded thread pool, so the event loop is not blocked and
+#the filesystem latency of the items of an ItemCollection overlaps. Time spent on I/O is recorded for each item
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import socket
+log = logging.getLogger("uvicorn.error")
+FS_WORKERS=int(conf.get('fs_workers',16))
+fs_executor=ThreadPoolExecutor(max_workers=FS_WORKERS,thread_name_prefix='reg-api-fs')
+io_stats={"items":0,"staging_seconds":0.0,"store_seconds":0.0,"max_item_seconds":0.0}
+
+def timed_call(func, *args):
+  start=time.monotonic()
+  result=func(*args)
+  return result,time.monotonic()-start
+
+async def run_in_fs_executor(func, *args):
+  #Returns the result of the function and the time spent running it (waiting for a free thread is not included)
+  return await asyncio.get_running_loop().run_in_executor(fs_executor,timed_call,func,*args)
+
+async def prepare_item_in_executor(assets_source: str, assets_dest: str, stac_dest: str, datastore_url: str, collectionId: str, validated_item: dict):
+  if 'failure_reason' in validated_item:
+    metrics.inc("regapi_items_failed_total",(("collection",collectionId),))
+    return validated_item
+  prepared_item,io_seconds=await run_in_fs_executor(prepare_item,assets_source,assets_dest,stac_dest,datastore_url,collectionId,validated_item)
+  io_stats['staging_seconds']+=io_seconds
+  if 'failure_reason' in prepared_item:
+    metrics.inc("regapi_items_failed_total",(("collection",collectionId),))
+  else:
+    prepared_item['started']=validated_item['started']
+    prepared_item['staging_seconds']=io_seconds
+    prepared_item['phases']['validate']+=io_seconds-prepared_item['phases']['staging']
+  return prepared_item
+
+async def store_item_in_executor(prepared_item: dict):
+  stored_item,io_seconds=await run_in_fs_executor(store_item,prepared_item)
+  io_stats['store_seconds']+=io_seconds
+  item_io_seconds=prepared_item['staging_seconds']+io_seconds
+  io_stats['items']+=1
+  io_stats['max_item_seconds']=max(io_stats['max_item_seconds'],item_io_seconds)
+  log.debug(f"Item {prepared_item['item']['id']} I/O time: {prepared_item['staging_seconds']:.3f}s staging checks, {io_seconds:.3f}s STAC backup and assets move")
+  return stored_item
+
+#Change journal. Ingested and deleted items are appended to hourly NDJSON files in the journal subfolder of the
+#datastore, read by reg-api-stats to update the statistics of the changed products only. Each gateway process
+#writes its own files (<YYYYMMDDHH>.<host>.<pid>.ndjson), so lines of concurrent workers are never interleaved.
+#The journal is disabled if journal_subfolder is empty
+JOURNAL_FOLDER=os.path.join(conf.get('datastore_folder',''),conf['journal_subfolder']) if conf.get('journal_subfolder','')!='' else None
+JOURNAL_FSYNC=conf.get('journal_fsync','true').lower()=='true'
+JOURNAL_HOST=socket.gethostname()
+if JOURNAL_FOLDER is not None:
+  os.makedirs(JOURNAL_FOLDER,exist_ok=True)
+
+def journal_event(event: str, collectionId: str, itemId: str, day: str):
+  if JOURNAL_FOLDER is None:
+    return
+  now=dt.datetime.now(dt.timezone.utc)
+  journal_file=os.path.join(JOURNAL_FOLDER,f"{now.strftime('%Y%m%d%H')}.{JOURNAL_HOST}.{os.getpid()}.ndjson")
+  line=json.dumps({"time":now.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),"event":event,"collection":collectionId,"day":day,"id":itemId})+'\n'
+  try:
+    fd=os.open(journal_file,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+    try:
+      os.write(fd,line.encode('utf-8'))
+      if JOURNAL_FSYNC:
+        os.fsync(fd)
+    finally:
+      os.close(fd)
+  except OSError as e:
+    log.error(f"Failed to journal {event} of item {collectionId}/{itemId} in {journal_file}: {e}")
+
+#Local index of the items ingested in each collection (ID, day of the datastore path, assets destinations relative
+#to the assets folder of the collection and size), kept in the gateway DB. Items are indexed when stored, and
+#removed from the index when deleted, so deletions find the datastore paths without getting the item from the
+#catalogue, and items already ingested are refused before their staging checks. The index of a collection is
+#filled from its STAC backups the first time the collection is used, in background by one of the workers (items
+#not indexed yet are still checked by the catalogue). Items of the index are trusted only if their STAC backup exists.
+#While the index of a collection is not completed, each worker checks it (and tries to claim its filling) at most
+#every ITEMS_INDEX_CHECK_INTERVAL seconds
+ITEMS_INDEX_BATCH=1000
+ITEMS_INDEX_CHECK_INTERVAL=60
+items_index_completed=set()
+items_index_checked={}
+items_index_tasks=set()
+
+def index_item(collectionId: str, itemId: str, day: str, assets: list, size: int):
+  get_gateway_db().execute("INSERT OR REPLACE INTO items(collection,id,day,assets,size) VALUES (?,?,?,?,?);",(collectionId,itemId,day,json.dumps(assets),size))
+
+def unindex_item(collectionId: str, itemId: str):
+  get_gateway_db().execute("DELETE FROM items WHERE collection=? AND id=?;",(collectionId,itemId))
+
+def lookup_item(collectionId: str, itemId: str):
+  #Returns the day of the datastore path of the item (YYYY/MM/DD), or None if the item is not indexed
+  row=get_gateway_db().execute("SELECT day FROM items WHERE collection=? AND id=?;",(collectionId,itemId)).fetchone()
+  return row[0] if row is not None else None
+
+def lookup_indexed_item(collectionId: str, stac_dest: str, itemId: str):
+  #Returns the day of the datastore path of the item, if indexed and its STAC backup exists (stale entries are removed)
+  day=lookup_item(collectionId,itemId)
+  if day is None:
+    return None
+  if not os.path.exists(os.path.join(stac_dest,day.replace('/',os.sep),itemId)):
+    unindex_item(collectionId,itemId)
+    return None
+  return day
+
+def lookup_items(collectionId: str, item_ids: list):
+  #Returns if the index of the collection is completed and the set of the IDs found in it
+  con=get_gateway_db()
+  found=set()
+  for k in range(0,len(item_ids),ITEMS_INDEX_BATCH):
+    ids=item_ids[k:k+ITEMS_INDEX_BATCH]
+    found.update(row[0] for row in con.execute(f"SELECT id FROM items WHERE collection=? AND id IN ({','.join('?'*len(ids))});",[collectionId]+ids))
+  return is_items_index_completed(collectionId),found
+
+def is_items_index_completed(collectionId: str):
+  if collectionId in items_index_completed:
+    return True
+  if get_gateway_db().execute("SELECT completed FROM items_index WHERE collection=?;",(collectionId,)).fetchone() is not None:
+    items_index_completed.add(collectionId)
+    return True
+  return False
+
+def claim_items_index(collectionId: str):
+  #Returns the claim to fill the index of the collection, or None if it is completed or being filled by another worker
+  if is_items_index_completed(collectionId):
+    return None
+  return acquire_claims([f"index:{collectionId}"])
+
+def complete_items_index(collectionId: str):
+  get_gateway_db().execute("INSERT OR REPLACE INTO items_index(collection,completed) VALUES (?,?);",(collectionId,time.time()))
+  items_index_completed.add(collectionId)
+
+async def ensure_items_index(collectionId: str, stac_dest: str, datastore_url: str):
+  #Start filling the index of the collection if it has not been filled yet (and no other worker is filling it)
+  if collectionId in items_index_completed or time.monotonic()-items_index_checked.get(collectionId,-ITEMS_INDEX_CHECK_INTERVAL)<ITEMS_INDEX_CHECK_INTERVAL:
+    return
+  items_index_checked[collectionId]=time.monotonic()
+  claims,claim_seconds=await run_in_fs_executor(claim_items_index,collectionId)
+  if claims is None:
+    return
+  #Not checked again until the filling ends
+  items_index_checked[collectionId]=float('inf')
+  task=asyncio.create_task(fill_items_index(collectionId,stac_dest,datastore_url,claims))
+  items_index_tasks.add(task)
+  task.add_done_callback(items_index_task_done)
+
+def items_index_task_done(task: asyncio.Task):
+  items_index_tasks.discard(task)
+  if not task.cancelled() and task.exception() is not None:
+    log.warning(f"Items index task failed: {task.exception()}")
+
+async def fill_items_index(collectionId: str, stac_dest: str, datastore_url: str, claims: list):
+  try:
+    indexed,io_seconds=await run_in_fs_executor(index_stac_backups,collectionId,stac_dest,datastore_url)
+    await run_in_fs_executor(complete_items_index,collectionId)
+    log.info(f"Indexed {indexed} items of collection {collectionId} in {io_seconds:.3f}s")
+  except Exception as e:
+    log.warning(f"Failed to index the items of collection {collectionId}: {e}")
+  finally:
+    items_index_checked[collectionId]=time.monotonic()
+    await run_in_fs_executor(release_claims,claims)
+
+def index_stac_backups(collectionId: str, stac_dest: str, datastore_url: str):
+  #STAC backups are in <stac_dest>/YYYY/MM/DD/<id>. Items already indexed (e.g. ingested meanwhile) are kept
+  con=get_gateway_db()
+  indexed=0
+  rows=[]
+  for day_path in sorted(glob.glob(os.path.join(stac_dest,'[0-9]'*4,'[0-9]'*2,'[0-9]'*2))):
+    day='/'.join(day_path.split(os.sep)[-3:])
+    with os.scandir(day_path) as it:
+      for entry in it:
+        if not entry.is_file():
+          continue
+        try:
+          with open(entry.path,'rb') as f:
+            i=json.load(f)
+        except Exception as e:
+          log.warning(f"Cannot index STAC backup {entry.path}: {e}")
+          continue
+        assets=set()
+        size=0
+        for asset in i.get('assets',{}).values():
+          if isinstance(asset,dict) and asset.get('href','').startswith(datastore_url):
+            assets.add('/'.join(asset['href'][len(datastore_url):].split('/')[:5]))
+            size+=asset.get('file:size',0)
+        rows.append((collectionId,entry.name,day,json.dumps(sorted(assets)),size))
+        if len(rows)>=ITEMS_INDEX_BATCH:
+          con.executemany("INSERT OR IGNORE INTO items(collection,id,day,assets,size) VALUES (?,?,?,?,?);",rows)
+          indexed+=len(rows)
+          rows=[]
+  con.executemany("INSERT OR IGNORE INTO items(collection,id,day,assets,size) VALUES (?,?,?,?,?);",rows)
+  return indexed+len(rows)
+
+#Metrics of the service, exposed in the Prometheus text format on /metrics: latency of each phase of the ingestion
+#and deletion of items, items and bytes registered per collection, catalogue requests by status and cache counters.
+#Each worker keeps its metrics in memory and saves them in the gateway DB every metrics_sync_interval seconds, so
+#/metrics reports the sum of all the workers. Items (and deletions) slower than slow_request_threshold seconds are
+#logged with their phases breakdown (0 disables the log)
+METRICS_SYNC_INTERVAL=float(conf.get('metrics_sync_interval',5))
+METRICS_RETENTION=86400
+#Row of the worker_metrics table with the counters of the workers stopped
+METRICS_RETIRED_PID=0
+SLOW_REQUEST_THRESHOLD=float(conf.get('slow_request_threshold',0))
+METRICS_BUCKETS=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0)
+METRICS_HELP={
+  "regapi_phase_seconds":("histogram","Time spent in each phase of the ingestion or deletion of an item"),
+  "regapi_operation_seconds":("histogram","Total time of the ingestion or deletion of an item"),
+  "regapi_items_registered_total":("counter","Items registered"),
+  "regapi_bytes_registered_total":("counter","Bytes of the local assets of the items registered"),
+  "regapi_items_failed_total":("counter","Items which failed registration"),
+  "regapi_items_deleted_total":("counter","Items deleted"),
+  "regapi_catalogue_requests_total":("counter","Requests to the catalogue, by method and HTTP status (or exception)"),
+  "regapi_catalogue_errors_total":("counter","Failed requests to the catalogue, by method and HTTP status (or exception)"),
+  "regapi_auth_cache_hits_total":("counter","Authentication and authorization cache hits"),
+  "regapi_auth_cache_misses_total":("counter","Authentication and authorization cache misses"),
+  "regapi_auth_cache_invalidations_total":("counter","Authentication and authorization cache invalidations (auth DB changed)"),
+  "regapi_auth_cache_entries":("gauge","Authentication and authorization cache entries"),
+  "regapi_trash_tombstones":("gauge","Deleted items (tombstones) in the trash waiting to be removed"),
+  "regapi_trash_tombstones_removed_total":("counter","Deleted items (tombstones) removed from the trash"),
+  "regapi_trash_reclaimed_bytes_total":("counter","Bytes of the files removed from the trash"),
+  "regapi_jobs_submitted_total":("counter","Ingestion jobs submitted (requests with the respond-async preference)"),
+  "regapi_jobs_completed_total":("counter","Ingestion jobs completed"),
+  "regapi_items_index_hits_total":("counter","Items found in the local items index, by operation (deletions without catalogue GET, items already ingested refused)"),
+}
+
+class Metrics:
+  def __init__(self):
+    self.lock=threading.Lock()
+    #Values are indexed by (metric name, labels), labels are tuples of (name, value)
+    self.values={}
+    self.histograms={}
+
+  def inc(self, name: str, labels: tuple = (), value: float = 1):
+    with self.lock:
+      self.values[(name,labels)]=self.values.get((name,labels),0)+value
+
+  def set(self, name: str, labels: tuple, value: float):
+    with self.lock:
+      self.values[(name,labels)]=value
+
+  def observe(self, name: str, labels: tuple, value: float):
+    #Histograms are the count of each bucket (not cumulative), followed by the sum and the count of the values
+    with self.lock:
+      histogram=self.histograms.get((name,labels))
+      if histogram is None:
+        histogram=self.histograms[(name,labels)]=[0]*(len(METRICS_BUCKETS)+3)
+      for idx,bucket in enumerate(METRICS_BUCKETS):
+        if value<=bucket:
+          break
+      else:
+        idx=len(METRICS_BUCKETS)
+      histogram[idx]+=1
+      histogram[-2]+=value
+      histogram[-1]+=1
+
+  def snapshot(self):
+    with self.lock:
+      return {"values":[[name,labels,value] for (name,labels),value in self.values.items()],
+              "histograms":[[name,labels,histogram] for (name,labels),histogram in self.histograms.items()]}
+
+metrics=Metrics()
+
+@contextmanager
+def timed_phase(phases: dict, phase: str):
+  start=time.monotonic()
+  try:
+    yield
+  finally:
+    phases[phase]=phases.get(phase,0.0)+time.monotonic()-start
+
+def record_catalogue_request(method: str, response_status: str, is_error: bool = True):
+  metrics.inc("regapi_catalogue_requests_total",(("method",method),("status",response_status)))
+  if is_error:
+    metrics.inc("regapi_catalogue_errors_total",(("method",method),("status",response_status)))
+
+#Time of the authentication and authorization of the current request (reported in the slow items log)
+request_auth_seconds=contextvars.ContextVar('request_auth_seconds',default=0.0)
+
+def record_request_auth(operation: str, auth_seconds: float):
+  request_auth_seconds.set(auth_seconds)
+  metrics.observe("regapi_phase_seconds",(("operation",operation),("phase","auth")),auth_seconds)
+
+def record_phases(operation: str, collectionId: str, itemId: str, phases: dict, total_seconds: float):
+  for phase,seconds in phases.items():
+    metrics.observe("regapi_phase_seconds",(("operation",operation),("phase",phase)),seconds)
+  metrics.observe("regapi_operation_seconds",(("operation",operation),),total_seconds)
+  if SLOW_REQUEST_THRESHOLD>0 and total_seconds>=SLOW_REQUEST_THRESHOLD:
+    breakdown=', '.join([f"{phase} {seconds:.3f}s" for phase,seconds in {"auth":request_auth_seconds.get(),**phases}.items()])
+    log.warning(f"Slow {operation} of item {collectionId}/{itemId}: {total_seconds:.3f}s ({breakdown})")
+
+def record_item_metrics(collectionId: str, prepared_item: dict, result: dict):
+  record_phases("ingest",collectionId,prepared_item['item']['id'],prepared_item['phases'],time.monotonic()-prepared_item['started'])
+  if 'failure_reason' in result:
+    metrics.inc("regapi_items_failed_total",(("collection",collectionId),))
+  else:
+    metrics.inc("regapi_items_registered_total",(("collection",collectionId),))
+    metrics.inc("regapi_bytes_registered_total",(("collection",collectionId),),prepared_item['bytes'])
+
+def metrics_snapshot():
+  #Snapshot of the metrics of this worker (with the current cache counters)
+  for cache_name,cache in [("credentials",credentials_cache),("authorization",authorization_cache)]:
+    cache_stats=cache.stats()
+    for counter in ["hits","misses","invalidations"]:
+      metrics.set(f"regapi_auth_cache_{counter}_total",(("cache",cache_name),),cache_stats[counter])
+    metrics.set("regapi_auth_cache_entries",(("cache",cache_name),),cache_stats['size'])
+  return json.dumps(metrics.snapshot())
+
+def write_metrics(snapshot: str):
+  #Save the metrics snapshot of this worker in the gateway DB, and retire the metrics of the dead workers (or of the
+  #ones which did not save them for metrics_retention seconds)
+  con=get_gateway_db()
+  con.execute("INSERT OR REPLACE INTO worker_metrics(pid,metrics,updated) VALUES (?,?,?);",(os.getpid(),snapshot,time.time()))
+  stale_pids=[]
+  for (pid,updated) in con.execute("SELECT pid,updated FROM worker_metrics WHERE pid!=?;",(METRICS_RETIRED_PID,)).fetchall():
+    if updated<time.time()-METRICS_RETENTION:
+      stale_pids.append(pid)
+      continue
+    try:
+      os.kill(pid,0)
+    except ProcessLookupError:
+      stale_pids.append(pid)
+    except PermissionError:
+      pass
+  retire_worker_metrics(stale_pids)
+
+def retire_worker_metrics(pids: list):
+  #The counters and histograms of the given workers are added to the retired metrics, so the totals do not go back
+  #when the workers stop. Their gauges are dropped
+  if len(pids)==0:
+    return
+  con=get_gateway_db()
+  con.execute("BEGIN IMMEDIATE;")
+  try:
+    rows=con.execute(f"SELECT pid,metrics FROM worker_metrics WHERE pid IN ({','.join('?'*(len(pids)+1))});",[METRICS_RETIRED_PID]+pids).fetchall()
+    #The workers may have been retired by another one in the meantime
+    if any(pid!=METRICS_RETIRED_PID for (pid,k) in rows):
+      values,histograms=sum_metrics([(json.loads(k),False) for (pid,k) in rows])
+      retired={"values":[[name,labels,value] for (name,labels),value in values.items()],
+               "histograms":[[name,labels,histogram] for (name,labels),histogram in histograms.items()]}
+      con.execute(f"DELETE FROM worker_metrics WHERE pid IN ({','.join('?'*len(pids))});",pids)
+      con.execute("INSERT OR REPLACE INTO worker_metrics(pid,metrics,updated) VALUES (?,?,?);",(METRICS_RETIRED_PID,json.dumps(retired),time.time()))
+    con.execute("COMMIT;")
+  except:
+    con.execute("ROLLBACK;")
+    raise
+
+def retire_previous_worker_metrics():
+  #Metrics with the PID of this worker are leftovers of a previous run (PIDs are reused when the service restarts)
+  retire_worker_metrics([os.getpid()])
+
+def save_metrics():
+  write_metrics(metrics_snapshot())
+
+async def save_metrics_loop():
+  #The snapshot is taken in the event loop, where the metrics are updated, and written in the executor
+  while True:
+    await asyncio.sleep(METRICS_SYNC_INTERVAL)
+    try:
+      await run_in_fs_executor(write_metrics,metrics_snapshot())
+    except Exception as e:
+      log.warning(f"Failed to save worker metrics: {e}")
+
+def sum_metrics(snapshots: list):
+  #Sum the metrics snapshots, given as (snapshot, with gauges). Returns the values and histograms by (name, labels)
+  values={}
+  histograms={}
+  for worker_metrics,with_gauges in snapshots:
+    for name,labels,value in worker_metrics['values']:
+      if not with_gauges and METRICS_HELP.get(name,('counter',))[0]=='gauge':
+        continue
+      key=(name,tuple(tuple(k) for k in labels))
+      values[key]=values.get(key,0)+value
+    for name,labels,histogram in worker_metrics['histograms']:
+      key=(name,tuple(tuple(k) for k in labels))
+      histograms[key]=[a+b for a,b in zip(histograms.get(key,[0]*len(histogram)),histogram)]
+  return values,histograms
+
+def format_metrics():
+  #Sum the metrics of all the workers, and format them in the Prometheus text format. Gauges are reported only for
+  #the live workers, counters also for the dead ones (their metrics not retired yet, and the retired ones)
+  snapshots=[]
+  for (pid,worker_metrics) in get_gateway_db().execute("SELECT pid,metrics FROM worker_metrics;").fetchall():
+    alive=pid!=METRICS_RETIRED_PID
+    if alive:
+      try:
+        os.kill(pid,0)
+      except ProcessLookupError:
+        alive=False
+      except PermissionError:
+        pass
+    snapshots.append((json.loads(worker_metrics),alive))
+  values,histograms=sum_metrics(snapshots)
+  lines=[]
+  for name,(metric_type,metric_help) in METRICS_HELP.items():
+    lines+=[f"# HELP {name} {metric_help}",f"# TYPE {name} {metric_type}"]
+    for (key_name,labels),value in sorted(values.items()):
+      if key_name==name:
+        lines.append(f"{name}{format_metric_labels(labels)} {value}")
+    for (key_name,labels),histogram in sorted(histograms.items()):
+      if key_name==name:
+        cumulative=0
+        for bucket,count in zip(list(METRICS_BUCKETS)+['+Inf'],histogram[:-2]):
+          cumulative+=count
+          lines.append(f"{name}_bucket{format_metric_labels(labels+(('le',str(bucket)),))} {cumulative}")
+        lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram[-2]}")
+        lines.append(f"{name}_count{format_metric_labels(labels)} {histogram[-1]}")
+  return '\n'.join(lines)+'\n'
+
+def format_metric_labels(labels: tuple):
+  if len(labels)==0:
+    return ''
+  escaped_labels=[(k,str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')) for k,v in labels]
+  return '{'+','.join([f'{k}="{v}"' for k,v in escaped_labels])+'}'
+
 #Rewrite the validation error to make it look like a GeoJSON error
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
@@ -110,6 +807,10 @@ The API response will contain, in case of success, the ingested STAC Item or a S
 
 The API response will contain, in case of failure, a JSON entry with the _id_ of the STAC Item to be ingested and a _failure_reason_ message for the STAC Items which failed ingestion.
 
+All the STAC Items of an ItemCollection are checked before any of them is ingested. STAC Items with the same _id_ of another STAC Item of the ItemCollection, or with assets in the staging area which are also assets of another STAC Item of the ItemCollection, are not ingested.
+
+If the request has the `Prefer: respond-async` HTTP header, the STAC Items are checked and then ingested in background: the API response (HTTP status 202) contains the _id_ of the ingestion job, and its `Location` header the address of the job (`/jobs/{jobId}`), which reports the result of each STAC Item once ingested. The request is processed as usual (without a job) if all the STAC Items fail the checks.
+
 Examples of API request and response are provided below. Please note that this API operation will require authorization.
   """,
   status_code=201,
@@ -182,6 +883,11 @@ Examples of API request and response are provided below. Please note that this A
   ]
 }
     }}}}}, 
+    202: {"description": "Accepted. The items are ingested in background (request with the `Prefer: respond-async` header)","content":{"application/json":{"examples":{"Job":{"value":
+      {"job_id": "5f0c7d3e9a2b4c1d8e6f7a8b9c0d1e2f",
+       "status": "queued",
+       "items": 1}
+    }}}}},
     422: {"description": "Validation error. Failed to add one or more items. Error in the response","content":{"application/json":{"examples":{"Item":{"value":
       {"id": "the id of the item which failed to be ingested if determined",
        "failure_reason": "a text describing the error"}
@@ -197,6 +903,7 @@ Examples of API request and response are provided below. Please note that this A
   }
 )
 async def collection_items_post_request(
+  request: Request,
   user_id: int = Depends(get_current_username),
   collectionId: str = Path(example="PRR_TEST"),                                          
   body: dict = Body(openapi_examples={"single":{"summary":"Item","value":{
@@ -250,7 +957,23 @@ async def collection_items_post_request(
   }}})
                                         ):
   #Check if user is authorized to the collection
+  auth_start=time.monotonic()
   (assets_source, assets_dest, stac_dest, datastore_url,catalogue_post_url,extra_auths) = check_user_collection_authorization(user_id,collectionId)
+  record_request_auth("ingest",request.state.auth_seconds+time.monotonic()-auth_start)
+  await ensure_items_index(collectionId,stac_dest,datastore_url)
+
+  #Ingest the items in background if requested (RFC 7240 preference)
+  if JOBS_WORKERS>0 and 'respond-async' in [k.strip().lower() for k in request.headers.get('prefer','').split(',')]:
+    if 'type' in body and body['type']=='Feature':
+      features=[body]
+    elif 'type' in body and body['type']=='FeatureCollection' and 'features' in body and isinstance(body['features'],list) and len(body['features'])>0:
+      features=body['features']
+    else:
+      raise HTTPException(status_code=422, detail="You need to post an item of the type Feature or FeatureCollection")
+    validated_items,validate_seconds=await run_in_fs_executor(validate_batch,assets_source,collectionId,features)
+    if any('failure_reason' not in k for k in validated_items):
+      job=await submit_job(user_id,collectionId,body['type'],features,validated_items)
+      return JSONResponse(status_code=202,content=job,headers={"Location":str(request.url_for('job_request',jobId=job['job_id'])),"Preference-Applied":"respond-async"})
 
   #Check what type of GeoJSON this is and call the ingestion accordingly
   if 'type' in body and body['type']=='Feature':
@@ -259,7 +982,7 @@ async def collection_items_post_request(
     #Construct response
     response_body = ingested_item
     if 'failure_reason' in response_body:
-      if response_body['failure_reason'] == 'Item already exists':
+      if response_body['failure_reason'] in CONFLICT_FAILURE_REASONS:
         response_status=409
       else:
         response_status=422
@@ -267,34 +990,355 @@ async def collection_items_post_request(
       response_status=201
   elif 'type' in body and body['type']=='FeatureCollection' and 'features' in body and isinstance(body['features'],list) and len(body['features'])>0:
     #Multiple items to ingest
-    ingested_items = await asyncio.gather(*[add_item_to_collection(assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId,k) for k in body['features']])
+    #All the items are checked before ingesting any of them
+    validated_items,validate_seconds=await run_in_fs_executor(validate_batch,assets_source,collectionId,body['features'])
+    ingested_items = await add_validated_items_to_collection(assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId,validated_items)
     #Construct response
     response_body = { 'type':'FeatureCollection','features':ingested_items }
-    response_status=201
-    for ingested in ingested_items:
-      if 'failure_reason' in ingested:
-        if ingested['failure_reason'] == 'Item already exists':
-          response_status=409
-        else:
-          response_status=422
-          break
+    response_status=items_response_status(ingested_items)
   else:
     #Invalid request
     raise HTTPException(status_code=422, detail="You need to post an item of the type Feature or FeatureCollection")
 
   return JSONResponse(status_code=response_status,content=response_body)
 
+@app.post(
+  "/collections/{collectionId}/items/ndjson",
+  tags=["Implemented transaction operations:"],
+  summary="Register a stream of Items (NDJSON)",
+  description="""This call performs the registration of a stream of [STAC Items](https://github.com/radiantearth/stac-spec/blob/master/item-spec/item-spec.md) into the Catalogue. It is meant for big ingestions (e.g. tens of thousands of items), which are not practical as a single STAC ItemCollection.
+
+To access it, you need to be registered as Data Provider and authorized to publish in the Catalogue collection (_{collectionId}_ in the API endpoint path).
+
+The POST request body needs to be of `application/x-ndjson` content type, and contain one STAC Item per line. Each STAC Item shall follow the profile and the constrains described above. Items are processed while the request is received, several at a time.
+
+The API response is of `application/x-ndjson` content type too, and it is streamed back while the items are ingested: one line per item, in the same order of the request. Each line contains, in case of success, the ingested STAC Item as present in the Catalogue, and in case of failure a JSON entry with the _id_ of the STAC Item and a _failure_reason_ message, as for the ItemCollection registration. The HTTP status of the response is always 200.
+
+Please note that this API operation will require authorization.
+  """,
+  status_code=200,
+  response_class=StreamingResponse,
+  responses={
+    200: {"description": "Stream of ingestion results, one for each item.","content":{"application/x-ndjson":{"example":
+      """{"type": "Feature", "id": "the id of the item ingested", "...": "..."}\n{"id": "the id of the item which failed to be ingested", "failure_reason": "Item already exists"}\n"""
+    }}},
+    415: {"description": "The request body is not of application/x-ndjson content type"}
+  }
+)
+async def collection_items_ndjson_post_request(
+  request: Request,
+  user_id: int = Depends(get_current_username),
+  collectionId: str = Path(example="PRR_TEST")):
+  #Check if user is authorized to the collection
+  auth_start=time.monotonic()
+  (assets_source, assets_dest, stac_dest, datastore_url,catalogue_post_url,extra_auths) = check_user_collection_authorization(user_id,collectionId)
+  record_request_auth("ingest",request.state.auth_seconds+time.monotonic()-auth_start)
+  await ensure_items_index(collectionId,stac_dest,datastore_url)
+  if request.headers.get('content-type','').split(';',1)[0].strip() not in NDJSON_CONTENT_TYPES:
+    raise HTTPException(status_code=415, detail=f"The request body needs to be of {NDJSON_CONTENT_TYPES[0]} content type")
+  return NDJSONStreamingResponse(ingest_ndjson_stream(request,assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId),media_type=NDJSON_CONTENT_TYPES[0])
+
+#Ingestion of NDJSON streams. Up to NDJSON_MAX_CONCURRENCY items are ingested at the same time, and results
+#are sent back in the same order of the request lines, so the memory used does not depend on the stream size
+NDJSON_CONTENT_TYPES=['application/x-ndjson','application/ndjson']
+NDJSON_MAX_CONCURRENCY=int(conf.get('ndjson_max_concurrency',32))
+
+class NDJSONStreamingResponse(StreamingResponse):
+  #The response is sent while the request body is still being received. StreamingResponse listens for the client
+  #disconnection consuming the request messages, so this is not done here (disconnections are detected when
+  #reading the request body or sending the response)
+  async def __call__(self, scope, receive, send):
+    await self.stream_response(send)
+
+async def read_ndjson_lines(request: Request):
+  buffer=b''
+  async for chunk in request.stream():
+    buffer+=chunk
+    *lines,buffer=buffer.split(b'\n')
+    for line in lines:
+      if line.strip():
+        yield line
+  if buffer.strip():
+    yield buffer
+
+async def ingest_ndjson_line(assets_source: str, assets_dest: str, stac_dest: str, datastore_url: str, catalogue_post_url: str, collectionId: str, line: bytes):
+  try:
+    i=json.loads(line)
+  except Exception as e:
+    return {"id":"unknown","failure_reason":f"Invalid JSON line: {e}"}
+  if not isinstance(i,dict) or i.get('type')!='Feature':
+    return {"id":i.get('id','unknown') if isinstance(i,dict) else 'unknown',"failure_reason":"You need to post items of the type Feature"}
+  try:
+    return await add_item_to_collection(assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId,i)
+  except Exception as e:
+    return {"id":i.get('id','unknown'),"failure_reason":f"Failed to ingest item: Exception: {e}"}
+
+async def ingest_ndjson_stream(request: Request, assets_source: str, assets_dest: str, stac_dest: str, datastore_url: str, catalogue_post_url: str, collectionId: str):
+  pending=deque()
+  async for line in read_ndjson_lines(request):
+    pending.append(asyncio.ensure_future(ingest_ndjson_line(assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId,line)))
+    #Send back the results already available, and wait for the oldest item when the concurrency limit is reached
+    while len(pending)>0 and (pending[0].done() or len(pending)>=NDJSON_MAX_CONCURRENCY):
+      yield json.dumps(await pending.popleft())+'\n'
+  while len(pending)>0:
+    yield json.dumps(await pending.popleft())+'\n'
+
+#HTTP status of the response of an ItemCollection ingestion
+def items_response_status(ingested_items: list):
+  response_status=201
+  for ingested in ingested_items:
+    if 'failure_reason' in ingested:
+      if ingested['failure_reason'] in CONFLICT_FAILURE_REASONS:
+        response_status=409
+      else:
+        response_status=422
+        break
+  return response_status
+
+#Ingestion jobs. ItemCollections posted with the respond-async preference are checked, then stored in the gateway
+#DB (one row per item) and ingested in background by JOBS_WORKERS tasks of each worker process, so the request
+#does not wait for the catalogue and the storage. Items of a job are ingested JOBS_CHUNK_SIZE at a time, and the
+#result of each chunk is stored before the next one, so the jobs of a dead (or restarted) worker are queued
+#again and continue from the first item without result. On shutdown, the chunks being ingested are completed.
+#Completed jobs are removed after JOBS_RETENTION hours. The jobs DB queries and the checks of the items run in the
+#executor, so large jobs do not block the requests served by the worker
+JOBS_WORKERS=int(conf.get('jobs_workers',4))
+JOBS_POLL_INTERVAL=float(conf.get('jobs_poll_interval',1))
+JOBS_CHUNK_SIZE=int(conf.get('jobs_chunk_size',100))
+JOBS_RETENTION=float(conf.get('jobs_retention_hours',24))*3600
+jobs_queued=asyncio.Event()
+jobs_stopping=asyncio.Event()
+
+async def submit_job(user_id: int, collectionId: str, body_type: str, features: list, validated_items: list):
+  job_id=os.urandom(16).hex()
+  await run_in_fs_executor(insert_job,job_id,user_id,collectionId,body_type,features,validated_items)
+  metrics.inc("regapi_jobs_submitted_total",(("collection",collectionId),))
+  jobs_queued.set()
+  return {"job_id":job_id,"status":"queued","items":len(features)}
+
+def insert_job(job_id: str, user_id: int, collectionId: str, body_type: str, features: list, validated_items: list):
+  #Items which failed the checks have their result already
+  now=time.time()
+  con=get_gateway_db()
+  con.execute("BEGIN IMMEDIATE;")
+  try:
+    con.execute("INSERT INTO jobs(id,user_id,collection,type,status,items,pid,created,updated) VALUES (?,?,?,?,'queued',?,NULL,?,?);",(job_id,user_id,collectionId,body_type,len(features),now,now))
+    con.executemany("INSERT INTO job_items(job,idx,id,item,result) VALUES (?,?,?,?,?);",[(job_id,idx,validated_item['id'] if 'failure_reason' in validated_item else validated_item['item']['id'],json.dumps(feature),json.dumps(validated_item) if 'failure_reason' in validated_item else None) for idx,(feature,validated_item) in enumerate(zip(features,validated_items))])
+    con.execute("COMMIT;")
+  except:
+    con.execute("ROLLBACK;")
+    raise
+
+def take_job():
+  #Returns the oldest queued job (now running in this worker), or None
+  con=get_gateway_db()
+  con.execute("BEGIN IMMEDIATE;")
+  try:
+    job=con.execute("SELECT id,user_id,collection FROM jobs WHERE status='queued' ORDER BY created LIMIT 1;").fetchone()
+    if job is not None:
+      con.execute("UPDATE jobs SET status='running',pid=?,updated=? WHERE id=?;",(os.getpid(),time.time(),job[0]))
+    con.execute("COMMIT;")
+  except:
+    con.execute("ROLLBACK;")
+    raise
+  return job
+
+def requeue_stale_jobs():
+  #Jobs of dead workers (or not updated for claim_timeout seconds) are queued again
+  con=get_gateway_db()
+  stale_jobs=[]
+  for (job_id,pid,updated) in con.execute("SELECT id,pid,updated FROM jobs WHERE status='running';").fetchall():
+    if updated<time.time()-CLAIM_TIMEOUT:
+      stale_jobs.append((job_id,pid))
+      continue
+    try:
+      os.kill(pid,0)
+    except ProcessLookupError:
+      stale_jobs.append((job_id,pid))
+    except PermissionError:
+      pass
+  con.executemany("UPDATE jobs SET status='queued',pid=NULL WHERE id=? AND pid=? AND status='running';",stale_jobs)
+  return len(stale_jobs)
+
+def requeue_worker_jobs():
+  #Running jobs with the PID of this worker are leftovers of a previous run
+  get_gateway_db().execute("UPDATE jobs SET status='queued',pid=NULL WHERE pid=? AND status='running';",(os.getpid(),))
+
+def read_job_chunk(job_id: str):
+  #Returns the next items (index and STAC Item) without result
+  return get_gateway_db().execute("SELECT idx,item FROM job_items WHERE job=? AND result IS NULL ORDER BY idx LIMIT ?;",(job_id,JOBS_CHUNK_SIZE)).fetchall()
+
+def save_job_results(job_id: str, chunk: list, results: list):
+  con=get_gateway_db()
+  con.execute("BEGIN IMMEDIATE;")
+  try:
+    con.executemany("UPDATE job_items SET result=? WHERE job=? AND idx=?;",[(json.dumps(result),job_id,idx) for (idx,item),result in zip(chunk,results)])
+    con.execute("UPDATE jobs SET updated=? WHERE id=? AND pid=?;",(time.time(),job_id,os.getpid()))
+    con.execute("COMMIT;")
+  except:
+    con.execute("ROLLBACK;")
+    raise
+
+def complete_job(job_id: str):
+  get_gateway_db().execute("UPDATE jobs SET status='completed',updated=? WHERE id=? AND pid=?;",(time.time(),job_id,os.getpid()))
+
+def read_job(job_id: str, user_id: int):
+  #Returns the job of the user and the id and result of its items, or None
+  con=get_gateway_db()
+  job=con.execute("SELECT collection,type,status,items,created,updated FROM jobs WHERE id=? AND user_id=?;",(job_id,user_id)).fetchone()
+  if job is None:
+    return None
+  return job,con.execute("SELECT id,result FROM job_items WHERE job=? ORDER BY idx;",(job_id,)).fetchall()
+
+def remove_expired_jobs():
+  con=get_gateway_db()
+  expired=[k[0] for k in con.execute("SELECT id FROM jobs WHERE status='completed' AND updated<?;",(time.time()-JOBS_RETENTION,)).fetchall()]
+  for job_id in expired:
+    con.execute("DELETE FROM job_items WHERE job=?;",(job_id,))
+    con.execute("DELETE FROM jobs WHERE id=?;",(job_id,))
+
+async def jobs_worker_loop():
+  while not jobs_stopping.is_set():
+    try:
+      job,take_seconds=await run_in_fs_executor(take_job)
+      if job is None:
+        await run_in_fs_executor(requeue_stale_jobs)
+        await run_in_fs_executor(remove_expired_jobs)
+        jobs_queued.clear()
+        try:
+          await asyncio.wait_for(jobs_queued.wait(),JOBS_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+          pass
+        continue
+      await run_job(*job)
+    except Exception as e:
+      log.warning(f"Failed to run ingestion job: {e}")
+      await asyncio.sleep(JOBS_POLL_INTERVAL)
+
+async def run_job(job_id: str, user_id: int, collectionId: str):
+  while not jobs_stopping.is_set():
+    chunk,read_seconds=await run_in_fs_executor(read_job_chunk,job_id)
+    if len(chunk)==0:
+      break
+    features=[json.loads(k[1]) for k in chunk]
+    try:
+      (assets_source, assets_dest, stac_dest, datastore_url,catalogue_post_url,extra_auths) = check_user_collection_authorization(user_id,collectionId)
+      #Items are checked again, as the staging area may have changed since the job submission
+      validated_items,validate_seconds=await run_in_fs_executor(validate_batch,assets_source,collectionId,features)
+      results=await add_validated_items_to_collection(assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId,validated_items)
+    except HTTPException as e:
+      results=[{"id":k.get('id','unknown'),"failure_reason":e.detail} for k in features]
+    except Exception as e:
+      results=[{"id":k.get('id','unknown'),"failure_reason":f"Failed to ingest item: Exception: {e}"} for k in features]
+    await run_in_fs_executor(save_job_results,job_id,chunk,results)
+  if jobs_stopping.is_set():
+    return
+  await run_in_fs_executor(complete_job,job_id)
+  metrics.inc("regapi_jobs_completed_total",(("collection",collectionId),))
+
+async def stop_jobs_workers(jobs_tasks: list):
+  #Jobs interrupted are queued again, and continue from the first chunk not ingested
+  jobs_stopping.set()
+  jobs_queued.set()
+  await asyncio.gather(*jobs_tasks,return_exceptions=True)
+  requeue_worker_jobs()
+
+@app.get(
+  "/jobs/{jobId}",
+  tags=["Implemented transaction operations:"],
+  summary="Status of an ingestion job",
+  description="""This call reports the status of an ingestion job, created by a POST request with the `Prefer: respond-async` HTTP header, and the result of each of its STAC Items.
+
+The _status_ of the job is `queued`, `running` or `completed`. The _features_ list contains, in the same order of the request, the result of each STAC Item as in the response of the ItemCollection registration (the ingested STAC Item, or a JSON entry with the _id_ of the STAC Item and a _failure_reason_ message), or just the _id_ and `"status": "pending"` for the STAC Items not ingested yet. Once the job is completed, _status_code_ is the HTTP status the request would have had without the `Prefer: respond-async` header.
+
+Only the user who created the job can access it. Jobs are available for a limited time after their completion.""",
+  responses={
+    200: {"description": "Status of the job.","content":{"application/json":{"examples":{"Job":{"value":
+      {"job_id": "5f0c7d3e9a2b4c1d8e6f7a8b9c0d1e2f",
+       "collection": "PRR_TEST",
+       "status": "running",
+       "items": 2,
+       "items_completed": 1,
+       "features": [
+         {"id": "the id of the item which failed to be ingested", "failure_reason": "Item already exists"},
+         {"id": "the id of the item to be ingested", "status": "pending"}
+       ]}
+    }}}}},
+    404: {"description": "Job not found."}
+  }
+)
+async def job_request(
+  user_id: int = Depends(get_current_username),
+  jobId: str = Path(example="5f0c7d3e9a2b4c1d8e6f7a8b9c0d1e2f")):
+  job,read_seconds=await run_in_fs_executor(read_job,jobId,user_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail="Job not found")
+  (collectionId,body_type,job_status,items,created,updated),results=job
+  features=[json.loads(result) if result is not None else {"id":item_id,"status":"pending"} for (item_id,result) in results]
+  response_body={"job_id":jobId,"collection":collectionId,"status":job_status,
+    "created":dt.datetime.fromtimestamp(created,dt.timezone.utc).isoformat(),"updated":dt.datetime.fromtimestamp(updated,dt.timezone.utc).isoformat(),
+    "items":items,"items_completed":sum(1 for (item_id,result) in results if result is not None),"features":features}
+  if job_status=='completed':
+    response_body['status_code']=items_response_status(features)
+  return response_body
+
 def valid_id_match(strg, search=re.compile(r'[^a-zA-Z0-9._-]').search, lenmax=100):
   if len(strg)>lenmax: return False
   return not bool(search(strg))
 
 async def add_item_to_collection(assets_source: str, assets_dest: str, stac_dest: str, datastore_url: str, catalogue_post_url: str, collectionId: str, i: dict):
+  validated_item=validate_item(assets_source,collectionId,i)
+  return await add_validated_item_to_collection(assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId,validated_item)
+
+async def add_validated_item_to_collection(assets_source: str, assets_dest: str, stac_dest: str, datastore_url: str, catalogue_post_url: str, collectionId: str, validated_item: dict):
+  #Check the assets of the STAC Item in the staging area
+  prepared_item=await prepare_item_in_executor(assets_source,assets_dest,stac_dest,datastore_url,collectionId,validated_item)
+  if 'failure_reason' in prepared_item:
+    return prepared_item
+  #Post it to the catalogue, then store the STAC backup and move the assets
+  result=await register_and_store_item(catalogue_post_url,collectionId,prepared_item)
+  record_item_metrics(collectionId,prepared_item,result)
+  return result
+
+async def add_validated_items_to_collection(assets_source: str, assets_dest: str, stac_dest: str, datastore_url: str, catalogue_post_url: str, collectionId: str, validated_items: list):
+  if CATALOGUE_BULK:
+    return await add_items_to_collection_bulk(assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId,validated_items)
+  return await asyncio.gather(*[add_validated_item_to_collection(assets_source,assets_dest,stac_dest,datastore_url,catalogue_post_url,collectionId,k) for k in validated_items])
+
+async def register_and_store_item(catalogue_post_url: str, collectionId: str, prepared_item: dict):
+  #The claims are written in the executor, as the gateway DB may be locked by the other workers
+  claims,claim_seconds=await run_in_fs_executor(claim_item,collectionId,prepared_item)
+  if claims is None:
+    return {"id":prepared_item['item']['id'],"failure_reason":CONFLICT_FAILURE_REASONS[1]}
+  try:
+    return await register_and_store_claimed_item(catalogue_post_url,collectionId,prepared_item)
+  finally:
+    await run_in_fs_executor(release_claims,claims)
+
+#If check_existing, an item already in the catalogue with the same content is considered registered (e.g. by a
+#bulk request whose response has been lost), so its assets are stored anyway
+async def register_and_store_claimed_item(catalogue_post_url: str, collectionId: str, prepared_item: dict, check_existing: bool = False):
+  registration_failure=await register_item(catalogue_post_url,collectionId,prepared_item)
+  if registration_failure is not None:
+    if not check_existing or registration_failure['failure_reason']!="Item already exists" or not await catalogue_item_matches(catalogue_post_url,collectionId,prepared_item):
+      return registration_failure
+  return await store_item_in_executor(prepared_item)
+
+#STAC Item checks which do not need any I/O
+FILE_EXTENSION_SCHEMA='https://stac-extensions.github.io/file/v2.1.0/schema.json'
+ITEM_DATETIME_PROPERTIES=['start_datetime','end_datetime','datetime']
+ASSET_MANDATORY_METADATA={'href':str,'type':str,'roles':list,'file:size':int}
+
+#Check the STAC Item metadata, without any I/O (each datetime is parsed once). Returns the failure (id and
+#failure_reason) or the validated item, with its datetime and the paths of its local assets in the staging area
+def validate_item(assets_source: str, collectionId: str, i: dict):
+  started=time.monotonic()
   #Check for validity of the STAC
-  if 'id' not in i:
+  if not isinstance(i,dict) or 'id' not in i:
     return {"id":"unknown","failure_reason":"ID is required in the STAC item to be ingested"}
-  if not valid_id_match(i['id'],lenmax=100):
+  if not isinstance(i['id'],str) or not valid_id_match(i['id'],lenmax=100):
     return {"id":i['id'],"failure_reason":"ID field is invalid. Only [a-zA-Z0-9._-] are allowed"}
-  if 'stac_extensions' not in i or not isinstance(i['stac_extensions'], list) or 'https://stac-extensions.github.io/file/v2.1.0/schema.json' not in i['stac_extensions']:
+  if 'stac_extensions' not in i or not isinstance(i['stac_extensions'], list) or FILE_EXTENSION_SCHEMA not in i['stac_extensions']:
     return {"id":i['id'],"failure_reason":"STAC Extension 'https://stac-extensions.github.io/storage/v1.0.0/schema.json' is required"}
   if 'collection' not in i:
     i['collection']=collectionId
@@ -306,37 +1350,34 @@ async def add_item_to_collection(assets_source: str, assets_dest: str, stac_dest
   if 'geometry' not in i:
     #Add default empty geometry
     i['geometry']=None
-  if 'properties' not in i:
+  if 'properties' not in i or not isinstance(i['properties'],dict):
     return {"id":i['id'],"failure_reason":"Missing required property field from the STAC JSON"}
-  if 'start_datetime' not in i['properties']: return {"id":i['id'],"failure_reason":"Missing required start_datetime from the STAC JSON"}
-  if 'end_datetime' not in i['properties']: return {"id":i['id'],"failure_reason":"Missing required end_datetime from the STAC JSON"}
-  if 'datetime' not in i['properties'] or i['properties']['datetime'] is None:
-    i['properties']['datetime']=i['properties']['start_datetime']
-  for a in ['start_datetime','end_datetime','datetime']:
+  properties=i['properties']
+  if 'start_datetime' not in properties: return {"id":i['id'],"failure_reason":"Missing required start_datetime from the STAC JSON"}
+  if 'end_datetime' not in properties: return {"id":i['id'],"failure_reason":"Missing required end_datetime from the STAC JSON"}
+  if 'datetime' not in properties or properties['datetime'] is None:
+    properties['datetime']=properties['start_datetime']
+  item_datetimes={}
+  for a in ITEM_DATETIME_PROPERTIES:
     try:
-      item_datetime_str_orig=i['properties'][a]
-      item_datetime_obj=dt.datetime.fromisoformat(item_datetime_str_orig)
-      item_datetime_str_new=item_datetime_obj.strftime('%Y-%m-%dT%H:%M:%SZ')
+      item_datetimes[a]=dt.datetime.fromisoformat(properties[a])
     except Exception as e:
-      return {"id":i['id'],"failure_reason":f"Failed to parse product date time. {item_datetime_str_orig} is an invalid ISO time"}
-  #Extract all the local assets (and check that they are available)
-  if not 'assets' in i:
+      return {"id":i['id'],"failure_reason":f"Failed to parse product date time. {properties[a]} is an invalid ISO time"}
+  #Extract all the local assets
+  if not 'assets' in i or not isinstance(i['assets'],dict):
     #Error, one asset at least is mandatory
     return {"id":i['id'],"failure_reason":f"No assets provided. At least one asset with role 'data' or 'documentation' is mandatory."}
-    
-  #Scan the assets to check for compliancy and flag directory and file assets to be moved
-  assets_dict=i['assets']
+
+  #Scan the assets to check for compliancy
   #Check at least one asset with role 'data' or 'documentation' role is provided
   data_is_present=False
-  assets_to_move={}
-  for asset_key in assets_dict:
-    asset=assets_dict[asset_key]
-
+  staging_assets={}
+  for asset_key,asset in i['assets'].items():
     #Check mandatory metadata for the asset are provided
-    mandatory_metadata={'href':str,'type':str,'roles':list,'file:size':int}
-    for a in mandatory_metadata:
+    if not isinstance(asset,dict): return {"id":i['id'],"failure_reason":f"{asset_key} asset is invalid."}
+    for a in ASSET_MANDATORY_METADATA:
       if a not in asset: return {"id":i['id'],"failure_reason":f"{asset_key} asset does not have the mandatory '{a}' metadata."}
-      if not isinstance(asset[a],mandatory_metadata[a]): return {"id":i['id'],"failure_reason":f"{asset_key} asset metadata '{a}' is invalid."}
+      if not isinstance(asset[a],ASSET_MANDATORY_METADATA[a]): return {"id":i['id'],"failure_reason":f"{asset_key} asset metadata '{a}' is invalid."}
     #Check asset has 'data' or 'documentation' role
     if not data_is_present and ('data' in asset['roles'] or 'documentation' in asset['roles']):
       data_is_present=True
@@ -350,16 +1391,81 @@ async def add_item_to_collection(assets_source: str, assets_dest: str, stac_dest
     if not staging_asset_path.startswith(assets_source):
       #You are trying to escape the assets_source path
       return {"id":i['id'],"failure_reason":f"{asset_key} asset {asset['href']} is out of the staging area"}
+    staging_assets[asset_key]=staging_asset_path
+  #Error if we do not have one asset with the role data nor documentation
+  if data_is_present == False:
+    return {"id":i['id'],"failure_reason":f"At least one asset with role 'data' or 'documentation' is mandatory."}
+
+  return {"item":i,
+          "datetime":item_datetimes['datetime'],
+          "staging_assets":staging_assets,
+          "started":started,
+          "validate_seconds":time.monotonic()-started}
+
+#Check all the STAC Items of an ItemCollection before ingesting any of them. Besides the checks of each item, items
+#with the same ID, or with local assets which are also assets of another item of the batch (the same path, or a
+#path inside a directory asset of the other item), are refused: whichever is ingested first, the other would fail
+#after its staging checks or catalogue registration. As the datastore destination of the assets is in the folder
+#of the item ID, destinations of the items of the batch cannot overlap once IDs are unique.
+#Returns the validated items (or their failures) in the same order of the features
+def validate_batch(assets_source: str, collectionId: str, features: list):
+  validated_items=[validate_item(assets_source,collectionId,k) for k in features]
+  valid_items=[idx for idx,validated_item in enumerate(validated_items) if 'failure_reason' not in validated_item]
+  failures={}
+  items_ids={}
+  for idx in valid_items:
+    items_ids.setdefault(validated_items[idx]['item']['id'],[]).append(idx)
+  for item_id,idxs in items_ids.items():
+    if len(idxs)>1:
+      for idx in idxs:
+        failures[idx]="ID is not unique. Another item in the ItemCollection has the same ID"
+  #Items of each staging path (and the asset key of the path in the item)
+  staging_paths={}
+  for idx in valid_items:
+    for asset_key,staging_asset_path in validated_items[idx]['staging_assets'].items():
+      staging_paths.setdefault(staging_asset_path,{}).setdefault(idx,asset_key)
+  for staging_asset_path,path_items in staging_paths.items():
+    #Items using the same path, or the path of one of its parent directories
+    overlapping=dict(path_items)
+    parent_path=staging_asset_path
+    while len(parent_path)>len(assets_source):
+      parent_path=os.path.dirname(parent_path)
+      for idx,asset_key in staging_paths.get(parent_path,{}).items():
+        overlapping.setdefault(idx,asset_key)
+    if len(overlapping)>1:
+      for idx,asset_key in overlapping.items():
+        failures.setdefault(idx,f"{asset_key} asset {validated_items[idx]['item']['assets'][asset_key]['href']} is also an asset of another item in the ItemCollection")
+  for idx,failure_reason in failures.items():
+    validated_items[idx]={"id":validated_items[idx]['item']['id'],"failure_reason":failure_reason}
+  return validated_items
+
+#Check the assets of the validated STAC Item in the staging area, and rewrite the assets href to point to the datastore.
+#Returns the failure (id and failure_reason) or the item prepared for registration, with the paths of its
+#STAC backup and assets to be moved
+def prepare_item(assets_source: str, assets_dest: str, stac_dest: str, datastore_url: str, collectionId: str, validated_item: dict):
+  i=validated_item['item']
+  #Refuse items already ingested
+  if lookup_indexed_item(collectionId,stac_dest,i['id']) is not None:
+    metrics.inc("regapi_items_index_hits_total",(("operation","ingest"),))
+    return {"id":i['id'],"failure_reason":CONFLICT_FAILURE_REASONS[0]}
+  #Check the local assets exist and flag directory and file assets to be moved
+  phases={'validate':validated_item['validate_seconds'],'staging':0.0}
+  assets_bytes=0
+  assets_to_move={}
+  for asset_key,staging_asset_path in validated_item['staging_assets'].items():
+    asset=i['assets'][asset_key]
     #Check if the assets exist in the storage
     try:
-      statinfo = os.stat(staging_asset_path)
+      with timed_phase(phases,'staging'):
+        statinfo = os.stat(staging_asset_path)
     except FileNotFoundError:
       return {"id":i['id'],"failure_reason":f"{asset_key} asset {asset['href']} not found in the staging area location"}
+    assets_bytes+=asset['file:size']
     #We behave differently if this is a file or a directory
     if stat.S_ISREG(statinfo.st_mode):
       #This is a regular file
       #Check the file size
-      if stat.S_ISREG(statinfo.st_mode) and statinfo.st_size != asset['file:size']:
+      if statinfo.st_size != asset['file:size']:
         return {"id":i['id'],"failure_reason":f"Asset {asset_key} is invalid. File size does not match the one of the file in the S3 stagein path"}
       assets_to_move[staging_asset_path]=asset_key
     elif stat.S_ISDIR(statinfo.st_mode):
@@ -367,12 +1473,9 @@ async def add_item_to_collection(assets_source: str, assets_dest: str, stac_dest
       assets_to_move[staging_asset_path+os.sep]=asset_key
     else:
       return {"id":i['id'],"failure_reason":f"{asset_key} asset {asset['href']} is not a file nor a directory."}
-  #Error if we do not have one asset with the role data nor documentation
-  if data_is_present == False:
-    return {"id":i['id'],"failure_reason":f"At least one asset with role 'data' or 'documentation' is mandatory."}
 
   #Determine where to move the assets. Destination for the asset is calculated using the collection and the asset start time if present. This is to not overload the file system with too many assets and have one unique way of representing assets in the datastore.
-  assets_base_date=dt.datetime.fromisoformat(i['properties']['datetime']).strftime(f'%Y{os.sep}%m{os.sep}%d')
+  assets_base_date=validated_item['datetime'].strftime(f'%Y{os.sep}%m{os.sep}%d')
   assets_base_path=os.path.join(assets_base_date,i["id"])
   assets_to_move_src=[]
   assets_to_move_dst=[]
@@ -404,37 +1507,70 @@ async def add_item_to_collection(assets_source: str, assets_dest: str, stac_dest
       #The asset is in a directory which has been already moved
       #Just rewrite the asset
       i['assets'][asset_key]['href']=last_assed_move_href+staging_asset_path[len(last_assed_move_src):]
-    
-    #Error if we do not have one asset with the role data nor documentation
-    if data_is_present == False:
-      return {"id":i['id'],"failure_reason":f"At least one asset with role 'data' or 'documentation' is mandatory."}
-  #Post the STAC Item to the catalogue
-  #Construct catalogue request
-  stac_item=json.dumps(i).encode("utf-8")
-  req = URLlibRequest(catalogue_post_url, stac_item, headers={'Content-Type':'application/geo+json'}, method='POST')
+
+  #The item is ready to be posted
+  return {"item":i,
+          "stac_item":json.dumps(i).encode("utf-8"),
+          "backup_stac_item":os.path.join(os.path.join(stac_dest,assets_base_date),i['id']),
+          "day":validated_item['datetime'].strftime('%Y/%m/%d'),
+          "assets_to_move_src":assets_to_move_src,
+          "assets_to_move_dst":assets_to_move_dst,
+          "phases":phases,
+          "bytes":assets_bytes}
+
+#Post the STAC Item to the catalogue. Returns the failure or None if the item has been registered
+async def register_item(catalogue_post_url: str, collectionId: str, prepared_item: dict):
+  i=prepared_item['item']
+  stac_item=prepared_item['stac_item']
   try:
-    response = URLlibUrlopen(req)
-  except HTTPError as e:
-    if e.code==409:
-      return {"id":i['id'],"failure_reason":f"Item already exists"}
-    else:
-      response_text=e.read().decode('utf-8')
-      response_status=str(e)
-      return {"id":i['id'],"failure_reason":f"Catalogue refused STAC: {response_status}: {response_text}"}
-  except URLError as e:
-    response_status='URLError'
+    with timed_phase(prepared_item['phases'],'catalogue_post'):
+      response = await catalogue_request('POST',catalogue_post_url,collectionId,stac_item)
+  except httpx.TransportError as e:
+    response_status='TransportError'
+    response_text=str(e)
     return {"id":i['id'],"failure_reason":f"Catalogue refused STAC: {response_status}: {response_text}"}
   except Exception as e:
     response_status='Exception'
     response_text=str(e)
     return {"id":i['id'],"failure_reason":f"Catalogue refused STAC: {response_status}: {response_text}"}
+  if response.status_code==409:
+    return {"id":i['id'],"failure_reason":f"Item already exists"}
+  elif response.is_error:
+    response_text=response.text
+    response_status=catalogue_response_status(response)
+    return {"id":i['id'],"failure_reason":f"Catalogue refused STAC: {response_status}: {response_text}"}
+  return None
+
+#Check if the item registered in the catalogue is the one to be ingested. The links are ignored, as these are
+#added by the catalogue
+async def catalogue_item_matches(catalogue_post_url: str, collectionId: str, prepared_item: dict):
+  i=prepared_item['item']
+  try:
+    with timed_phase(prepared_item['phases'],'catalogue_get'):
+      response = await catalogue_request('GET',os.path.join(catalogue_post_url,i['id']),collectionId)
+    registered_item=json.loads(response.content) if not response.is_error else None
+  except Exception as e:
+    log.warning(f"Cannot get item {collectionId}/{i['id']} from the catalogue: {e}")
+    return False
+  if not isinstance(registered_item,dict):
+    return False
+  return all(registered_item.get(k)==v for k,v in i.items() if k!='links')
+
+#Store the STAC Item backup and move the assets from the staging area to the datastore
+def store_item(prepared_item: dict):
+  i=prepared_item['item']
+  stac_item=prepared_item['stac_item']
+  backup_stac_item=prepared_item['backup_stac_item']
+  assets_to_move_src=prepared_item['assets_to_move_src']
+  assets_to_move_dst=prepared_item['assets_to_move_dst']
+  phases=prepared_item['phases']
 
   #Now save STAC item
-  backup_stac_item=os.path.join(os.path.join(stac_dest,assets_base_date),i['id'])
   try:
-    os.makedirs(os.path.dirname(backup_stac_item), exist_ok=True)
-    with open(backup_stac_item,'wb') as f:
-      f.write(stac_item)
+    with timed_phase(phases,'stac_backup'):
+      os.makedirs(os.path.dirname(backup_stac_item), exist_ok=True)
+      with open(backup_stac_item,'wb') as f:
+        f.write(stac_item)
   except Exception as e:
     response_status='Exception'
     response_text=str(e)
@@ -444,19 +1580,139 @@ async def add_item_to_collection(assets_source: str, assets_dest: str, stac_dest
   for idx,asset_src in enumerate(assets_to_move_src):
     asset_dst=assets_to_move_dst[idx]
     try:
-      #Move file
-      os.makedirs(os.path.dirname(asset_dst), exist_ok=True)
-      os.rename(asset_src,asset_dst)
-      #Cleanup XATTR metadata (if any)
-      if os.path.exists(asset_src+'.xattr'): os.remove(asset_src+'.xattr')
+      #Move file (never overwrite an asset already in the datastore)
+      with timed_phase(phases,'asset_move'):
+        if os.path.lexists(asset_dst):
+          raise FileExistsError(f"{asset_dst} already exists")
+        os.makedirs(os.path.dirname(asset_dst), exist_ok=True)
+        os.rename(asset_src,asset_dst)
+        #Cleanup XATTR metadata (if any)
+        if os.path.exists(asset_src+'.xattr'): os.remove(asset_src+'.xattr')
     except Exception as e:
       response_status='Exception'
       response_text=str(e)
       return {"id":i['id'],"failure_reason":f"Failed to store asset {os.path.basename(asset_dst)} in datastore: {response_status}: {response_text}"}
 
-  #All ok, return the updated product
+  #Remove the stagein folders named as the item (used by the clients publishing several products at once), once empty
+  for staging_folder in set(os.path.dirname(k) for k in assets_to_move_src if os.path.basename(os.path.dirname(k))==i['id']):
+    try:
+      os.rmdir(staging_folder)
+    except OSError:
+      pass
+
+  #All ok, index, journal and return the updated product
+  try:
+    index_item(i['collection'],i['id'],prepared_item['day'],[f"{prepared_item['day']}/{i['id']}/{os.path.basename(k)}" for k in assets_to_move_dst],prepared_item['bytes'])
+  except sqlite3.Error as e:
+    log.error(f"Failed to index item {i['collection']}/{i['id']}: {e}")
+  journal_event('ingest',i['collection'],i['id'],prepared_item['day'])
   return i
 
+#Bulk ingestion of an ItemCollection. All the items are checked first, then the valid ones are posted to the
+#catalogue in batches via the bulk transaction endpoint. If a batch is refused (e.g. one item already exists)
+#or the catalogue does not support bulk transactions, the items are posted one by one, so each of them gets
+#its own result. Results are returned in the same order of the features
+async def add_items_to_collection_bulk(assets_source: str, assets_dest: str, stac_dest: str, datastore_url: str, catalogue_post_url: str, collectionId: str, validated_items: list):
+  ingested_items=await asyncio.gather(*[prepare_item_in_executor(assets_source,assets_dest,stac_dest,datastore_url,collectionId,k) for k in validated_items])
+  valid_items=[idx for idx,prepared_item in enumerate(ingested_items) if 'failure_reason' not in prepared_item]
+  batches=[valid_items[k:k+CATALOGUE_BULK_SIZE] for k in range(0,len(valid_items),CATALOGUE_BULK_SIZE)]
+  batches_results=await asyncio.gather(*[add_batch_to_collection(catalogue_post_url,collectionId,[ingested_items[idx] for idx in batch]) for batch in batches])
+  for batch,batch_results in zip(batches,batches_results):
+    for idx,result in zip(batch,batch_results):
+      record_item_metrics(collectionId,ingested_items[idx],result)
+      ingested_items[idx]=result
+  return ingested_items
+
+async def add_batch_to_collection(catalogue_post_url: str, collectionId: str, prepared_batch: list):
+  #Claim the items of the batch, the ones already claimed by another request are not posted
+  batch_results=[None]*len(prepared_batch)
+  batch_claims=[]
+  claimed_batch=[]
+  items_claims,claim_seconds=await run_in_fs_executor(claim_items,collectionId,prepared_batch)
+  for idx,prepared_item in enumerate(prepared_batch):
+    claims=items_claims[idx]
+    if claims is None:
+      batch_results[idx]={"id":prepared_item['item']['id'],"failure_reason":CONFLICT_FAILURE_REASONS[1]}
+    else:
+      batch_claims+=claims
+      claimed_batch.append(idx)
+  try:
+    registered,uncertain=False,False
+    if len(claimed_batch)>0:
+      registered,uncertain=await register_items_bulk(catalogue_post_url,collectionId,[prepared_batch[idx] for idx in claimed_batch])
+    if registered:
+      claimed_results=await asyncio.gather(*[store_item_in_executor(prepared_batch[idx]) for idx in claimed_batch])
+    else:
+      #Fallback to one POST per item. If the bulk request may have been applied, the items already registered
+      #with the same content are stored
+      claimed_results=await asyncio.gather(*[register_and_store_claimed_item(catalogue_post_url,collectionId,prepared_batch[idx],uncertain) for idx in claimed_batch])
+  finally:
+    await run_in_fs_executor(release_claims,batch_claims)
+  for idx,result in zip(claimed_batch,claimed_results):
+    batch_results[idx]=result
+  return batch_results
+
+#Bulk endpoints which are not available in the catalogue, with the time until which they are not tried again
+CATALOGUE_BULK_RETRY_INTERVAL=600
+catalogue_bulk_unsupported={}
+
+#Post a batch of STAC Items to the catalogue bulk transaction endpoint. Returns (registered, uncertain): registered
+#is True if all the items are registered, uncertain is True if the request failed after being sent (timeout,
+#server error), so the catalogue may have registered the items anyway
+async def register_items_bulk(catalogue_post_url: str, collectionId: str, prepared_batch: list):
+  bulk_url=os.path.join(os.path.dirname(catalogue_post_url.rstrip('/')),CATALOGUE_BULK_ENDPOINT)
+  if catalogue_bulk_unsupported.get(bulk_url,0)>time.monotonic():
+    return False,False
+  #Items are indexed by ID in the bulk request, so the batch is posted one by one if it has duplicated IDs
+  bulk_items={prepared_item['item']['id']:prepared_item['item'] for prepared_item in prepared_batch}
+  if len(bulk_items)!=len(prepared_batch):
+    return False,False
+  try:
+    bulk_start=time.monotonic()
+    response = await catalogue_request('POST',bulk_url,collectionId,json.dumps({"items":bulk_items,"method":"insert"}).encode("utf-8"))
+  except (httpx.ConnectError,httpx.ConnectTimeout,httpx.PoolTimeout):
+    return False,False
+  except Exception:
+    return False,True
+  finally:
+    #All the items of the batch wait for the bulk request
+    for prepared_item in prepared_batch:
+      prepared_item['phases']['catalogue_post']=time.monotonic()-bulk_start
+  #A 404 about the collection (e.g. not created yet in the catalogue) does not mean that bulk transactions are unsupported
+  if response.status_code in [405,501] or (response.status_code==404 and 'collection' not in response.text.lower()):
+    catalogue_bulk_unsupported[bulk_url]=time.monotonic()+CATALOGUE_BULK_RETRY_INTERVAL
+    return False,False
+  return not response.is_error,response.is_server_error
+
+@app.post(
+  "/collections/{collectionId}/items/exists",
+  tags=["Implemented transaction operations:"],
+  summary="Check which Items are already registered",
+  description="""This call checks which of the given STAC Item IDs are already registered in the collection, using the local index of the items ingested by the gateway (the catalogue is not queried). It is meant for clients re-ingesting big sets of items, to skip the ones already registered.
+
+To access it, you need to be registered as Data Provider and authorized to publish in the Catalogue collection (_{collectionId}_ in the API endpoint path).
+
+The POST request body needs to contain the list of the STAC Item IDs to be checked (_ids_). The API response reports the IDs _found_ and _not_found_ in the index. The index of a collection is filled from the datastore the first time the collection is used: until it is _complete_, the IDs _not_found_ may be registered anyway.""",
+  responses={
+    200: {"description": "IDs found and not found in the items index.","content":{"application/json":{"examples":{"Items":{"value":
+      {"complete": True,
+       "found": ["the id of an item already registered"],
+       "not_found": ["the id of an item not registered"]}
+    }}}}}
+  }
+)
+async def collection_items_exists_request(
+  request: Request,
+  user_id: int = Depends(get_current_username),
+  collectionId: str = Path(example="PRR_TEST"),
+  body: dict = Body(example={"ids":["S3A_OPER_AUX_GNSSRD_POD__20171212T193142_V20160223T235943_20160224T225600"]})):
+  (assets_source, assets_dest, stac_dest, datastore_url,catalogue_post_url,extra_auths) = check_user_collection_authorization(user_id,collectionId)
+  await ensure_items_index(collectionId,stac_dest,datastore_url)
+  if not isinstance(body.get('ids'),list) or not all(isinstance(k,str) for k in body['ids']):
+    raise HTTPException(status_code=422, detail="You need to post the list of the item IDs to be checked (ids)")
+  (complete,found),lookup_seconds=await run_in_fs_executor(lookup_items,collectionId,body['ids'])
+  return {"complete":complete,"found":[k for k in body['ids'] if k in found],"not_found":[k for k in body['ids'] if k not in found]}
+
 @app.delete(
   "/collections/{collectionId}/items/{recordId}",
   tags=["Implemented transaction operations:"],
@@ -483,41 +1739,110 @@ Please note that this API will require special authorization. **Only administrat
     }
 )
 async def collection_items_del_request(
+  request: Request,
   user_id: int = Depends(get_current_username),
   collectionId: str = Path(example="PRR_TEST"),
   recordId: str = Path(example="S3A_OPER_AUX_GNSSRD_POD__20171212T193142_V20160223T235943_20160224T225600")):
 
   #Check if user is authorized to delete from the collection
+  auth_start=time.monotonic()
   (assets_source, assets_dest, stac_dest, datastore_url,catalogue_post_url,extra_auths) = check_user_collection_authorization(user_id,collectionId)
+  record_request_auth("delete",request.state.auth_seconds+time.monotonic()-auth_start)
   if extra_auths % 2 == 0:
     raise HTTPException(status_code=422, detail="User is not authorized to delete items in this collection")
+  await ensure_items_index(collectionId,stac_dest,datastore_url)
 
+  #Phases of the deletion are recorded also when it fails
+  phases={}
+  started=time.monotonic()
+  try:
+    response=await delete_item(collectionId,recordId,assets_dest,stac_dest,catalogue_post_url,phases)
+    metrics.inc("regapi_items_deleted_total",(("collection",collectionId),))
+    return response
+  finally:
+    record_phases("delete",collectionId,recordId,phases,time.monotonic()-started)
+
+#Delete the item from the catalogue, then its STAC backup and assets from the datastore. The time spent in each
+#phase is added to phases
+async def delete_item(collectionId: str, recordId: str, assets_dest: str, stac_dest: str, catalogue_post_url: str, phases: dict):
   #Final failure reason
   failure_reason=''
 
-  #Get the product from the catalogue (and also check it is actually there)
-  req = URLlibRequest(os.path.join(catalogue_post_url,recordId), headers={'Content-Type':'application/geo+json'}, method='GET')
+  #Find the datastore paths in the items index, or get the product from the catalogue (and also check it is actually there)
+  item_day,phases['index_lookup']=await run_in_fs_executor(lookup_indexed_item,collectionId,stac_dest,recordId)
+  if item_day is not None:
+    metrics.inc("regapi_items_index_hits_total",(("operation","delete"),))
+    itemId=recordId
+  else:
+    itemId,item_day=await get_catalogue_item_day(collectionId,recordId,catalogue_post_url,phases)
+  assets_base_date=item_day.replace('/',os.sep)
+  assets_base_path=os.path.join(assets_base_date,itemId)
+  assets_path_to_delete=os.path.join(assets_dest,assets_base_path)
+  stacs_path_to_delete=os.path.join(os.path.join(stac_dest,assets_base_date),itemId)
+
+  #Delete element form the catalogue collection
   try:
-    response = URLlibUrlopen(req)
-  except HTTPError as e:
-    if e.code==404:
+    with timed_phase(phases,'catalogue_delete'):
+      response = await catalogue_request('DELETE',os.path.join(catalogue_post_url,recordId),collectionId)
+  except httpx.TransportError as e:
+    response_status='TransportError'
+    response_text=str(e)
+    failure_reason=f"Catalogue refused DELETE: {response_status}: {response_text}"
+  except Exception as e:
+    response_status='Exception'
+    response_text=str(e)
+    failure_reason=f"Catalogue refused DELETE: {response_status}: {response_text}"
+  else:
+    if response.status_code==404:
+      await run_in_fs_executor(unindex_item,collectionId,itemId)
       raise HTTPException(status_code=404, detail={"id":recordId,"failure_reason":"Item not found"})
-    else:
-      response_text=e.read().decode('utf-8')
-      response_status=str(e)
-      failure_reason=f"Catalogue refused GET: {response_status}: {response_text}"
-  except URLError as e:
-    response_status='URLError'
+    elif response.is_error:
+      response_text=response.text
+      response_status=catalogue_response_status(response)
+      failure_reason=f"Catalogue refused DELETE: {response_status}: {response_text}"
+  if failure_reason!='':
+    raise HTTPException(status_code=422, detail=failure_reason)
+
+  #Move the STAC Item backup and assets to the trash (or delete them, if the trash is not available). The item is
+  #deleted from the catalogue, so it is always removed from the index and journaled
+  try:
+    failure_reason,phases['trash']=await run_in_fs_executor(trash_item,collectionId,itemId,stacs_path_to_delete,assets_path_to_delete)
+  except Exception as e:
+    failure_reason=f"Cannot delete STAC Item backup and assets: {e}"
+  finally:
+    await run_in_fs_executor(forget_item,collectionId,itemId,item_day)
+
+  #Return result
+  if failure_reason=='':
+    return JSONResponse(status_code=201,content={"id":recordId,"message":"deleted"})
+  else:
+    raise HTTPException(status_code=422, detail=failure_reason)
+
+#Get the item to delete from the catalogue. Returns its ID and the day of its datastore path (YYYY/MM/DD)
+async def get_catalogue_item_day(collectionId: str, recordId: str, catalogue_post_url: str, phases: dict):
+  failure_reason=''
+  try:
+    with timed_phase(phases,'catalogue_get'):
+      response = await catalogue_request('GET',os.path.join(catalogue_post_url,recordId),collectionId)
+  except httpx.TransportError as e:
+    response_status='TransportError'
     response_text=str(e)
     failure_reason=f"Catalogue refused GET: {response_status}: {response_text}"
   except Exception as e:
     response_status='Exception'
     response_text=str(e)
     failure_reason=f"Catalogue refused GET: {response_status}: {response_text}"
+  else:
+    if response.status_code==404:
+      raise HTTPException(status_code=404, detail={"id":recordId,"failure_reason":"Item not found"})
+    elif response.is_error:
+      response_text=response.text
+      response_status=catalogue_response_status(response)
+      failure_reason=f"Catalogue refused GET: {response_status}: {response_text}"
   if failure_reason!='':
     raise HTTPException(status_code=422, detail=failure_reason)
   try:
-    i=json.loads(response.read())
+    i=json.loads(response.content)
   except Exception as e:
     response_status='Exception'
     response_text=str(e)
@@ -538,43 +1863,171 @@ async def collection_items_del_request(
     item_datetime_obj=dt.datetime.fromisoformat(item_datetime_str)
   except Exception as e:
     raise HTTPException(status_code=422, detail={"id":i['id'],"failure_reason":"Failed to parse product date time. {item_datetime_str} is an invalid ISO time"})
-  assets_base_date=item_datetime_obj.strftime(f'%Y{os.sep}%m{os.sep}%d')
-  assets_base_path=os.path.join(assets_base_date,i["id"])
-  assets_path_to_delete=os.path.join(assets_dest,assets_base_path)
-  stacs_path_to_delete=os.path.join(os.path.join(stac_dest,assets_base_date),i['id'])
+  return i['id'],item_datetime_obj.strftime('%Y/%m/%d')
 
-  #Delete element form the catalogue collection
-  req = URLlibRequest(os.path.join(catalogue_post_url,recordId), headers={'Content-Type':'application/geo+json'}, method='DELETE')
+#Deleted items are moved (renamed) to a tombstone folder in the trash subfolder of the datastore
+#(<trash>/<collection>/<time>.<id>.<random>), so the deletion returns right away also for big assets (e.g. Zarr
+#directories with many files). The trash is emptied in background by the reaper of one of the workers (the one
+#holding the reaper claim in the gateway DB), removing up to trash_reaper_workers tombstones at a time. Tombstones
+#are just folders in the trash, so an interrupted removal continues at the next start. Items are deleted before
+#returning (in the filesystem executor) if the trash is disabled (no trash_subfolder) or on another filesystem
+TRASH_FOLDER=os.path.join(conf.get('datastore_folder',''),conf['trash_subfolder']) if conf.get('trash_subfolder','')!='' else None
+TRASH_REAPER_WORKERS=int(conf.get('trash_reaper_workers',2))
+TRASH_REAPER_INTERVAL=float(conf.get('trash_reaper_interval',10))
+TRASH_REAPER_CLAIM='reaper:trash'
+trash_reaper_stop=threading.Event()
+
+def forget_item(collectionId: str, itemId: str, day: str):
+  #Removes a deleted item from the index and journals its deletion
   try:
-    response = URLlibUrlopen(req)
-  except HTTPError as e:
-    response_text=e.read().decode('utf-8')
-    response_status=str(e)
-    failure_reason=f"Catalogue refused DELETE: {response_status}: {response_text}"
-  except URLError as e:
-    response_status='URLError'
-    response_text=str(e)
-    failure_reason=f"Catalogue refused DELETE: {response_status}: {response_text}"
-  except Exception as e:
-    response_status='Exception'
-    response_text=str(e)
-    failure_reason=f"Catalogue refused DELETE: {response_status}: {response_text}"
-  if failure_reason!='':
-    raise HTTPException(status_code=422, detail=failure_reason)
+    unindex_item(collectionId,itemId)
+  except sqlite3.Error as e:
+    log.error(f"Failed to unindex item {collectionId}/{itemId}: {e}")
+  journal_event('delete',collectionId,itemId,day)
 
-  #Delete STAC Item backup
-  if os.path.exists(stacs_path_to_delete):
-    os.remove(stacs_path_to_delete)
-  else:
-    failure_reason='Cannot delete STAC Item backup. It does not exist.'
-  #Delete STAC assets
-  if os.path.exists(assets_path_to_delete):
-    shutil.rmtree(assets_path_to_delete)
-  else:
-    failure_reason=failure_reason+'Cannot delete STAC Item Assets. They do not exist.'
+def trash_item(collectionId: str, itemId: str, stac_path: str, assets_path: str):
+  #Returns the failure reason ('' if the STAC Item backup and assets have been trashed). What cannot be moved to the
+  #trash (e.g. on another file system, or trash not writable) is deleted
+  failure_reason=''
+  tombstone=None
+  for path,name,label in [(stac_path,'stac','STAC Item backup'),(assets_path,'assets','STAC Item Assets')]:
+    if not os.path.lexists(path):
+      failure_reason+=f"Cannot delete {label}. {'It does' if name=='stac' else 'They do'} not exist."
+      continue
+    if TRASH_FOLDER is not None:
+      try:
+        if tombstone is None:
+          new_tombstone=os.path.join(TRASH_FOLDER,collectionId,f"{time.strftime('%Y%m%dT%H%M%S')}.{itemId}.{os.urandom(4).hex()}")
+          os.makedirs(new_tombstone)
+          tombstone=new_tombstone
+        os.rename(path,os.path.join(tombstone,name))
+        continue
+      except OSError as e:
+        if e.errno!=errno.EXDEV:
+          log.warning(f"Cannot move {path} to the trash: {e}. Deleting it")
+    try:
+      remove_tree(path)
+    except OSError as e:
+      failure_reason+=f"Cannot delete {label}: {e.strerror}."
+  #Tombstones left empty (nothing moved into them) are removed
+  if tombstone is not None:
+    try:
+      os.rmdir(tombstone)
+    except OSError:
+      pass
+  return failure_reason
 
-  #Return result
-  if failure_reason=='':
-    return JSONResponse(status_code=201,content={"id":recordId,"message":"deleted"})
-  else:
-    raise HTTPException(status_code=422, detail=failure_reason)
+def remove_tree(path: str, stop: threading.Event = None):
+  #Removes a file or a directory tree, returns the bytes of the files removed. If stop is set, the removal is
+  #interrupted (and None is returned)
+  if not os.path.isdir(path) or os.path.islink(path):
+    size=os.lstat(path).st_size
+    os.remove(path)
+    return size
+  size=0
+  for root,dirs,files in os.walk(path,topdown=False):
+    for name in files+[k for k in dirs if os.path.islink(os.path.join(root,k))]:
+      if stop is not None and stop.is_set():
+        return None
+      filepath=os.path.join(root,name)
+      size+=os.lstat(filepath).st_size
+      os.remove(filepath)
+    for name in dirs:
+      if not os.path.islink(os.path.join(root,name)):
+        os.rmdir(os.path.join(root,name))
+  os.rmdir(path)
+  return size
+
+def list_tombstones():
+  #Tombstones in the trash, the oldest first
+  tombstones=[]
+  if TRASH_FOLDER is None or not os.path.isdir(TRASH_FOLDER):
+    return tombstones
+  with os.scandir(TRASH_FOLDER) as it:
+    for coll_entry in it:
+      if coll_entry.is_dir(follow_symlinks=False):
+        with os.scandir(coll_entry.path) as it2:
+          tombstones+=[(entry.name,entry.path) for entry in it2]
+  return [path for name,path in sorted(tombstones)]
+
+def claim_trash_reaper():
+  #Returns True if this worker is the trash reaper. The claim is refreshed at each check, so it does not expire
+  con=get_gateway_db()
+  if con.execute("UPDATE claims SET created=? WHERE claim=? AND pid=?;",(time.time(),TRASH_REAPER_CLAIM,os.getpid())).rowcount>0:
+    return True
+  return acquire_claims([TRASH_REAPER_CLAIM]) is not None
+
+def reap_tombstone(tombstone: str):
+  #The reaper claim is refreshed before each removal, so it does not expire while emptying a big trash
+  if not claim_trash_reaper():
+    return None
+  return remove_tree(tombstone,trash_reaper_stop)
+
+async def trash_reaper_loop():
+  if TRASH_FOLDER is None:
+    return
+  reaper_executor=ThreadPoolExecutor(max_workers=TRASH_REAPER_WORKERS,thread_name_prefix='reg-api-reaper')
+  loop=asyncio.get_running_loop()
+  try:
+    while True:
+      try:
+        if await loop.run_in_executor(reaper_executor,claim_trash_reaper):
+          await reap_trash(reaper_executor)
+        else:
+          metrics.set("regapi_trash_tombstones",(),0)
+      except Exception as e:
+        log.warning(f"Failed to empty the trash: {e}")
+      await asyncio.sleep(TRASH_REAPER_INTERVAL)
+  finally:
+    trash_reaper_stop.set()
+    reaper_executor.shutdown(wait=False)
+
+async def reap_trash(reaper_executor: ThreadPoolExecutor):
+  loop=asyncio.get_running_loop()
+  tombstones=await loop.run_in_executor(reaper_executor,list_tombstones)
+  pending=[len(tombstones)]
+  metrics.set("regapi_trash_tombstones",(),pending[0])
+  async def reap(tombstone):
+    try:
+      reclaimed=await loop.run_in_executor(reaper_executor,reap_tombstone,tombstone)
+    except Exception as e:
+      log.warning(f"Failed to remove {tombstone} from the trash: {e}")
+      return
+    if reclaimed is not None:
+      pending[0]-=1
+      metrics.set("regapi_trash_tombstones",(),pending[0])
+      metrics.inc("regapi_trash_tombstones_removed_total")
+      metrics.inc("regapi_trash_reclaimed_bytes_total",(),reclaimed)
+  #The executor bounds the number of tombstones removed at the same time
+  await asyncio.gather(*[reap(k) for k in tombstones])
+
+async def stop_trash_reaper(reaper_task: asyncio.Task):
+  reaper_task.cancel()
+  try:
+    await reaper_task
+  except asyncio.CancelledError:
+    pass
+  release_claims([TRASH_REAPER_CLAIM])
+
+@app.get(
+  "/status",
+  tags=["Service status:"],
+  summary="Service status",
+  description="""This call reports the internal status of the service, like the hit and miss counters of the authentication and authorization caches and the time spent on filesystem I/O by the ingested items. If _status_auth_ is set in the configuration, the credentials of a registered user are required.""",
+  dependencies=[Depends(check_status_access)]
+)
+async def status_request():
+  return {"auth_cache":{"credentials":credentials_cache.stats(),"authorization":authorization_cache.stats()},"io":io_stats}
+
+@app.get(
+  "/metrics",
+  tags=["Service status:"],
+  summary="Service metrics",
+  description="""This call reports the service metrics in the Prometheus text format: latency histograms of each phase of the items ingestion and deletion, items and bytes registered per collection, catalogue requests and errors by HTTP status and authentication cache counters. Metrics are the sum of all the service workers, as saved by each of them every _metrics_sync_interval_ seconds. If _status_auth_ is set in the configuration, the credentials of a registered user are required.""",
+  response_class=PlainTextResponse,
+  dependencies=[Depends(check_status_access)]
+)
+async def metrics_request():
+  #Scrapes only read the snapshots saved by the workers, the gateway DB is read in the executor
+  metrics_text,read_seconds=await run_in_fs_executor(format_metrics)
+  return PlainTextResponse(metrics_text,media_type="text/plain; version=0.0.4")